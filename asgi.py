@@ -0,0 +1,266 @@
+'''
+    Serves our bottle routes on an asyncio event loop
+    Any ASGI server (uvicorn, hypercorn, ...) can run application()
+
+    Ordinary requests go through the same WSGI app that gunicorn serves, but
+    the app runs in a thread pool so sqlite and bcrypt never block the loop.
+    Chat streams are handled on the loop itself, an idle stream is only a
+    waiting coroutine rather than a whole worker, so thousands can stay open
+'''
+import asyncio
+import http.cookies
+import io
+import sys
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import bottle
+
+import model
+import controller
+import hub
+
+# Paths handled natively on the event loop instead of through bottle
+STREAM_PATH = '/chat/stream'
+
+
+def build_environ(scope, body):
+    '''
+        Builds a WSGI environ for an ASGI http scope
+
+        :: scope :: The ASGI connection scope
+        :: body :: The full request body as bytes
+    '''
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'REMOTE_ADDR': client[0],
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope['headers']:
+        name = name.decode('latin1')
+        value = value.decode('latin1')
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'content-length':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = environ[key] + ',' + value if key in environ else value
+
+    return environ
+
+
+async def read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+class Application():
+    '''
+        An ASGI application wrapping a WSGI app
+    '''
+    def __init__(self, wsgi_app=None, max_workers=32):
+        '''
+            :: wsgi_app :: The WSGI app to serve, defaults to bottle's default app
+            :: max_workers :: Threads available for blocking work
+        '''
+        self.wsgi_app = wsgi_app or bottle.default_app()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        if scope['path'] == STREAM_PATH and scope['method'] == 'GET':
+            return await self.chat_stream(scope, receive, send)
+
+        body = await read_body(receive)
+        environ = build_environ(scope, body)
+        await self.call_wsgi(environ, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def run_blocking(self, function, *args):
+        '''
+            Runs a blocking call in the thread pool
+        '''
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def call_wsgi(self, environ, send):
+        '''
+            Runs the WSGI app in the thread pool and sends its response
+            Each chunk of the body is also pulled in the pool, so
+            generator responses never run on the loop
+        '''
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]
+
+        def first_chunk():
+            # Hand back any connection before this thread goes off to serve someone else
+            try:
+                body = self.wsgi_app(environ, start_response)
+                iterator = iter(body)
+                return body, iterator, next(iterator, None)
+            finally:
+                model.end_request()
+
+        def next_chunk(iterator):
+            try:
+                return next(iterator, None)
+            finally:
+                model.end_request()
+
+        body, iterator, chunk = await self.run_blocking(first_chunk)
+        try:
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            while chunk is not None:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await self.run_blocking(next_chunk, iterator)
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(body, 'close'):
+                await self.run_blocking(body.close)
+
+    async def chat_stream(self, scope, receive, send):
+        '''
+            Serves the same Server-Sent Events as controller.get_chat_stream,
+            waiting on the hub from the loop instead of from a thread
+        '''
+        query = urllib.parse.parse_qs(scope['query_string'].decode('latin1'))
+        headers = dict((name.decode('latin1'), value.decode('latin1')) for name, value in scope['headers'])
+        cookies = http.cookies.SimpleCookie(headers.get('cookie', ''))
+        token = cookies[model.SESSION_COOKIE].value if model.SESSION_COOKIE in cookies else None
+        friend = query.get('friend', [None])[0]
+        after = headers.get('last-event-id') or query.get('after', ['0'])[0]
+
+        if friend is None or not after.isdigit():
+            return await self.empty_response(send, 400)
+        after = int(after)
+
+        loop = asyncio.get_running_loop()
+        username, opened = await self.run_blocking(self.open_stream, token, friend, after, loop)
+        if username is None:
+            return await self.empty_response(send, 401)
+        if opened is None:
+            return await self.empty_response(send, 404)
+        subscription, missed = opened
+
+        # Finishes once the client hangs up
+        disconnected = asyncio.ensure_future(self.wait_for_disconnect(receive))
+        deadline = loop.time() + model.STREAM_LIFETIME
+        last_index = after
+
+        async def send_event(text):
+            await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': True})
+
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream; charset=UTF-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ]})
+            await send_event("retry: 1000\n\n")
+
+            while not disconnected.done():
+                for sender, message, message_index in missed:
+                    if message_index > last_index:
+                        last_index = message_index
+                        await send_event(model.message_event(sender, message, message_index))
+                missed = []
+
+                if loop.time() > deadline:
+                    break
+
+                getter = asyncio.ensure_future(subscription.get())
+                done, _ = await asyncio.wait([getter, disconnected], timeout=model.STREAM_POLL_INTERVAL,
+                    return_when=asyncio.FIRST_COMPLETED)
+                if getter not in done:
+                    getter.cancel()
+                    if disconnected in done:
+                        break
+
+                    # Idle, catch anything other processes stored
+                    await send_event(": keepalive\n\n")
+                    missed = await self.run_blocking(model.poll_messages, username, friend, last_index)
+                    continue
+
+                item = getter.result()
+                if item is hub.EVICTED:
+                    break
+                missed = [item]
+
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        except OSError:
+            # The client went away mid-send
+            pass
+        finally:
+            disconnected.cancel()
+            subscription.close()
+
+    def open_stream(self, token, friend, after, loop):
+        '''
+            Returns (username, (subscription, missed)), username is None without a valid session
+        '''
+        try:
+            session = model.get_session(token)
+            if session is None:
+                return None, None
+            return session.username, model.open_chat_stream(session.username, friend, after, loop=loop)
+        finally:
+            model.end_request()
+
+    async def wait_for_disconnect(self, receive):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+
+    async def empty_response(self, send, status):
+        await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-length', b'0')]})
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+def application(max_workers=32, wsgi_app=None):
+    '''
+        Returns the ASGI application for our routes
+
+        :: wsgi_app :: The WSGI app to serve, defaults to bottle's default app
+    '''
+    return Application(wsgi_app, max_workers=max_workers)
@@ -0,0 +1,132 @@
+'''
+    Fingerprinted static files
+
+    At startup every file in static/css, static/js and static/img is hashed
+    and given a URL with the hash in its name, e.g. css/main.css is served
+    as /static/css/main.3f2a1b9c0d4e.css. A URL like that never changes
+    what it points to, so browsers can keep it for a year without asking
+    again, and editing a file gives it a new URL after the next restart
+
+    Templates refer to assets through View's global renders, named after
+    the directory and file, e.g. ${css_main}, ${js_darkmode}, ${img_st}
+
+    Text files are also compressed once at startup, with every encoding
+    compression.py offers, and their fingerprinted URLs are served from
+    those copies
+'''
+import hashlib
+import mimetypes
+import os
+import re
+
+import compression
+
+# Sent with fingerprinted files
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# Sent with files requested by their plain name, so browsers check back for changes
+REVALIDATE = "no-cache"
+
+# Characters of the sha256 kept in a fingerprinted name
+HASH_LENGTH = 12
+
+
+def render_name(name):
+    '''
+        Returns the template variable for an asset, 'css/main.css' -> 'css_main'
+    '''
+    stem = os.path.splitext(name)[0]
+    return re.sub(r"[^0-9a-zA-Z_]", "_", stem)
+
+
+class Assets():
+    '''
+        Maps static files to and from their fingerprinted names
+    '''
+    def __init__(self, root="static", directories=("css", "js", "img"), prefix="/static/"):
+        '''
+            :: root :: Directory static files are served from
+            :: directories :: Subdirectories of root to fingerprint
+            :: prefix :: URL root is served under
+        '''
+        self.root = root
+        self.directories = directories
+        self.prefix = prefix
+
+        # 'css/main.css' -> 'css/main.3f2a1b9c0d4e.css', and back
+        self.fingerprinted = {}
+        self.originals = {}
+
+        # 'css/main.3f2a1b9c0d4e.css' -> encoding -> compressed contents
+        self.encoded = {}
+        self.scan()
+
+    def scan(self):
+        '''
+            Hashes every file, call again to pick up changes
+        '''
+        fingerprinted = {}
+        encoded = {}
+        for directory in self.directories:
+            top = os.path.join(self.root, directory)
+            for path, _, filenames in os.walk(top):
+                for filename in filenames:
+                    full_path = os.path.join(path, filename)
+                    name = os.path.relpath(full_path, self.root).replace(os.sep, "/")
+                    with open(full_path, "rb") as file:
+                        data = file.read()
+                    digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+                    stem, extension = os.path.splitext(name)
+                    hashed = "{stem}.{digest}{extension}".format(stem=stem, digest=digest, extension=extension)
+                    fingerprinted[name] = hashed
+                    encoded[hashed] = self.precompress(name, data)
+
+        self.fingerprinted = fingerprinted
+        self.encoded = encoded
+        self.originals = dict((hashed, name) for name, hashed in fingerprinted.items())
+
+    def precompress(self, name, data):
+        '''
+            Returns encoding -> compressed data, leaving out encodings that don't make it smaller
+        '''
+        content_type = mimetypes.guess_type(name)[0] or ""
+        if not compression.compressible(content_type):
+            return {}
+        encoded = {}
+        for encoding in compression.ENCODINGS:
+            compressed = compression.compress(data, encoding, level=9)
+            if len(compressed) < len(data):
+                encoded[encoding] = compressed
+        return encoded
+
+    def url(self, name):
+        '''
+            Returns the URL to link an asset with, its plain URL if it wasn't fingerprinted
+        '''
+        return self.prefix + self.fingerprinted.get(name, name)
+
+    def original(self, hashed):
+        '''
+            Returns the file a fingerprinted name refers to, or None if it isn't one of ours
+        '''
+        return self.originals.get(hashed)
+
+    def compressed(self, hashed, accept_encoding):
+        '''
+            Returns (encoding, data) to send for a fingerprinted name, or None to send the file as it is
+
+            :: accept_encoding :: The request's Accept-Encoding header
+        '''
+        encoded = self.encoded.get(hashed)
+        if not encoded:
+            return None
+        encoding = compression.choose_encoding(accept_encoding, [encoding for encoding in compression.ENCODINGS if encoding in encoded])
+        if encoding is None:
+            return None
+        return encoding, encoded[encoding]
+
+    def renders(self):
+        '''
+            Returns template variable -> URL for every asset, for View's global renders
+        '''
+        return dict((render_name(name), self.url(name)) for name in self.fingerprinted)
@@ -0,0 +1,325 @@
+'''
+    Measures what one server process can handle, route by route
+
+    Builds a temporary project.db, seeds it with users, friendships, guides
+    and messages, then calls controller.py's routes through the WSGI app in
+    this process from a pool of client threads. Nothing listens on a port,
+    so the numbers are the app's own cost without any network or TLS
+
+    Reports requests/sec and latency percentiles for each endpoint, and
+    writes them to a JSON file to compare between changes
+
+        python benchmarks/routes.py
+        python benchmarks/routes.py --users 500 --messages 50000 --concurrency 16 --requests 2000
+        python benchmarks/routes.py --endpoints login friend_list --json before.json
+
+    Logins run bcrypt at --bcrypt-rounds, the password pool turns some away
+    with a 503 once its queue is full, those are counted as busy
+'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PASSWORD = 'benchmark'
+
+
+def request(app, method, path, data=None, cookie=None):
+    '''
+        Calls the WSGI app once, returns the status code
+    '''
+    path, _, query = path.partition('?')
+    body = urllib.parse.urlencode(data or {}).encode('utf-8')
+    environ = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '8080',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'CONTENT_LENGTH': str(len(body)),
+        'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+    }
+    if cookie is not None:
+        environ['HTTP_COOKIE'] = cookie
+
+    status = []
+    def start_response(status_line, headers, exc_info=None):
+        status.append(int(status_line.split()[0]))
+
+    chunks = app(environ, start_response)
+    try:
+        for _ in chunks:
+            pass
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    return status[0]
+
+
+def seed(model, users, friends, guides, messages, bcrypt_rounds):
+    '''
+        Fills the database, returns the usernames and each user's friends
+    '''
+    import bcrypt
+
+    db = model.db
+    usernames = ['user{i}'.format(i=i) for i in range(users)]
+
+    # Everyone shares one hash, hashing each would take minutes
+    hashed = bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt(bcrypt_rounds))
+    db.query_many("add_user", [(username, hashed, 0) for username in usernames])
+
+    friend_lists = {}
+    for i, username in enumerate(usernames):
+        picked = [usernames[(i + step) % users] for step in range(1, min(friends, users - 1) + 1)]
+        friend_lists[username] = picked
+    db.query_many("add_friend", [(username, friend) for username, picked in friend_lists.items() for friend in picked])
+
+    db.query_many("add_guide", [('BENCH{i:04d}'.format(i=i), 'Course {i}'.format(i=i),
+        'Description of course {i}'.format(i=i)) for i in range(guides)])
+    db.commit()
+
+    # Spread the messages over every user's chat with their first friend
+    # Stored the way add_message stores them, all in one transaction
+    import sql
+
+    chats = [(username, picked[0]) for username, picked in friend_lists.items() if picked]
+    for i in range(messages):
+        sender, receiver = chats[i % len(chats)]
+        chat_id = db.get_conversation_id(sender, receiver, create=True)
+        sql.insert_message(db.query, chat_id, sender, receiver, 'Message number {i}'.format(i=i))
+    db.commit()
+    model.end_request()
+
+    return usernames, friend_lists
+
+
+def endpoints(model, usernames, friend_lists):
+    '''
+        Returns name -> function(app, i) making the i'th request of that kind
+        Each request comes from a random signed in user
+    '''
+    cookies = {}
+    for username in usernames:
+        cookies[username] = model.SESSION_COOKIE + '=' + model.session_store.create(username)
+    model.end_request()
+
+    def user():
+        username = random.choice(usernames)
+        friend = friend_lists[username][0] if friend_lists[username] else username
+        return username, friend, cookies[username]
+
+    def login(app, i):
+        username = random.choice(usernames)
+        return request(app, 'POST', '/login', {'username': username, 'password': PASSWORD})
+
+    def friend_list(app, i):
+        username, friend, cookie = user()
+        return request(app, 'POST', '/friend_list', cookie=cookie)
+
+    def add_todo(app, i):
+        username, friend, cookie = user()
+        return request(app, 'POST', '/todo', {'todo': 'Task {i}'.format(i=i)}, cookie=cookie)
+
+    def chat_page(app, i):
+        username, friend, cookie = user()
+        return request(app, 'POST', '/chat', {'receiver': friend}, cookie=cookie)
+
+    def chat_history(app, i):
+        username, friend, cookie = user()
+        return request(app, 'GET', '/chat/history?' + urllib.parse.urlencode({'friend': friend, 'before': 1000000}),
+            cookie=cookie)
+
+    def chat_send(app, i):
+        username, friend, cookie = user()
+        return request(app, 'POST', '/chat/send', {'receiver': friend, 'message': 'Benchmark {i}'.format(i=i)},
+            cookie=cookie)
+
+    return {
+        'login': login,
+        'friend_list': friend_list,
+        'add_todo': add_todo,
+        'chat_page': chat_page,
+        'chat_history': chat_history,
+        'chat_send': chat_send,
+    }
+
+
+def percentile(samples, fraction):
+    if len(samples) == 0:
+        return None
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def milliseconds(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+def run_endpoint(app, name, make_request, count, concurrency):
+    '''
+        Makes count requests from concurrency threads, returns the summary
+    '''
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    counter = iter(range(count))
+
+    def client():
+        mine = []
+        codes = {}
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                break
+            started = time.perf_counter()
+            try:
+                status = make_request(app, i)
+            except Exception:
+                status = 'exception'
+            mine.append(time.perf_counter() - started)
+            codes[status] = codes.get(status, 0) + 1
+        with lock:
+            latencies.extend(mine)
+            for status, seen in codes.items():
+                statuses[status] = statuses.get(status, 0) + seen
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    errors = sum(seen for status, seen in statuses.items() if status == 'exception' or (status >= 500 and status != 503))
+    return {
+        'endpoint': name,
+        'requests': count,
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 3),
+        'requests_per_sec': round(count / elapsed, 1),
+        'p50_ms': milliseconds(percentile(latencies, 0.50)),
+        'p90_ms': milliseconds(percentile(latencies, 0.90)),
+        'p99_ms': milliseconds(percentile(latencies, 0.99)),
+        'max_ms': milliseconds(latencies[-1] if latencies else None),
+        'busy': statuses.get(503, 0),
+        'errors': errors,
+        'statuses': dict((str(status), seen) for status, seen in statuses.items()),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args, parser):
+    '''
+        Seeds the database and runs every endpoint asked for
+    '''
+    import bottle
+    import model
+    import controller
+
+    model.db.migrate()
+    model.page_view.reload_templates = False
+    usernames, friend_lists = seed(model, args.users, args.friends, args.guides, args.messages, args.bcrypt_rounds)
+    scenarios = endpoints(model, usernames, friend_lists)
+    app = bottle.default_app()
+
+    names = args.endpoints or list(scenarios)
+    unknown = [name for name in names if name not in scenarios]
+    if unknown:
+        parser.error('unknown endpoints: {names}, pick from {known}'.format(
+            names=', '.join(unknown), known=', '.join(scenarios)))
+
+    results = []
+    for name in names:
+        # One untimed request so template loading isn't counted
+        scenarios[name](app, -1)
+        results.append(run_endpoint(app, name, scenarios[name], args.requests, args.concurrency))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--friends', type=int, default=10, help='friends each user has added')
+    parser.add_argument('--guides', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--requests', type=int, default=1000, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads')
+    parser.add_argument('--endpoints', nargs='+', default=None, help='endpoints to run, all by default')
+    parser.add_argument('--bcrypt-rounds', type=int, default=12)
+    parser.add_argument('--profile', default='durable', help='PRAGMA profile, see sql.PRAGMA_PROFILES')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for picking users')
+    parser.add_argument('--json', default='routes.json', help='file to write the results to')
+    parser.add_argument('--verbose', action='store_true', help="show the app's own output")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    json_path = os.path.abspath(args.json)
+    workdir = tempfile.mkdtemp(prefix='student-talk-routes-')
+
+    # model opens its database when it's imported, so point it at ours first
+    os.environ['STUDENT_TALK_DB'] = os.path.join(workdir, 'project.db')
+    os.environ['STUDENT_TALK_DB_PROFILE'] = args.profile
+    os.environ['STUDENT_TALK_BCRYPT_ROUNDS'] = str(args.bcrypt_rounds)
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+    try:
+        with quiet:
+            results = run(args, parser)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print('{:<14} {:>9} {:>9} {:>9} {:>9} {:>9} {:>6} {:>7}'.format(
+        'endpoint', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'busy', 'errors'))
+    for row in results:
+        print('{endpoint:<14} {requests_per_sec:>9} {p50:>9} {p90:>9} {p99:>9} {max:>9} {busy:>6} {errors:>7}'.format(
+            p50=str(row['p50_ms']), p90=str(row['p90_ms']), p99=str(row['p99_ms']), max=str(row['max_ms']), **row))
+
+    report = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'settings': {
+            'users': args.users,
+            'friends': args.friends,
+            'guides': args.guides,
+            'messages': args.messages,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'bcrypt_rounds': args.bcrypt_rounds,
+            'profile': args.profile,
+        },
+        'results': results,
+    }
+    with open(json_path, 'w') as file:
+        json.dump(report, file, indent=2)
+    print('Wrote {path}'.format(path=json_path))
+
+
+if __name__ == '__main__':
+    main()
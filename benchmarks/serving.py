@@ -0,0 +1,250 @@
+'''
+    Compares the gunicorn server with the async server
+
+    Each mode is started in its own process against a copy of project.db,
+    then a fixed number of client threads hammer a few pages while some chat
+    streams sit open and idle. Reports requests/sec, p50/p99 latency and
+    errors for each mode
+
+        python benchmarks/serving.py
+        python benchmarks/serving.py --streams 0 50 --concurrency 16 --duration 10 --json serving.json
+
+    Needs gunicorn and uvicorn installed. Servers run over plain HTTP here,
+    TLS costs the same in both modes
+'''
+import argparse
+import http.client
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Pages each client thread cycles through
+PATHS = [
+    '/about',
+    '/login',
+    '/chat/history?friend=Bob&before=1000000',
+]
+
+# The chat the idle streams watch
+STREAM_PATH = '/chat/stream?friend=Bob&after=1000000'
+
+# Who the clients are signed in as
+USERNAME = 'Alice'
+
+# gunicorn's worker settings, the same as run.py's 'server' command
+THREADS = 32
+LONG_POLL_LIMIT = THREADS // 2
+
+
+def serve(mode, port):
+    '''
+        Runs a server in this process, used by the child processes
+    '''
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+
+    import bottle
+    import model
+    import controller
+
+    model.db.migrate()
+    model.end_request()
+    # Workers open their own connections, none are inherited through the fork
+    model.db.pool.close()
+
+    if mode == 'gunicorn':
+        model.LONG_POLL_LIMIT = LONG_POLL_LIMIT
+        bottle.run(host='127.0.0.1', port=port, server='gunicorn', quiet=True,
+            worker_class='gthread', workers=1, threads=THREADS)
+    else:
+        import uvicorn
+        import asgi
+        uvicorn.run(asgi.application(), host='127.0.0.1', port=port, log_level='warning')
+
+
+def session_cookie(database):
+    '''
+        Signs USERNAME in on a copied database, returns the Cookie header to send
+    '''
+    sys.path.insert(0, ROOT)
+    import sql
+    import sessions
+
+    db = sql.SQLDatabase(database)
+    db.migrate()
+    token = sessions.SessionStore(db).create(USERNAME)
+    db.pool.close()
+    return 'session=' + token
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode, database):
+    port = free_port()
+    env = dict(os.environ, STUDENT_TALK_DB=database)
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', mode, '--port', str(port)],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 20
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("{mode} server didn't start".format(mode=mode))
+
+
+def stop_server(process):
+    # gunicorn waits for stuck requests before it exits
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def open_streams(port, count, cookie):
+    '''
+        Opens chat streams and leaves them idle
+    '''
+    streams = []
+    for _ in range(count):
+        sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        request = 'GET {path} HTTP/1.1\r\nHost: localhost\r\nAccept: text/event-stream\r\nCookie: {cookie}\r\n\r\n'.format(
+            path=STREAM_PATH, cookie=cookie)
+        sock.sendall(request.encode('latin1'))
+        streams.append(sock)
+    return streams
+
+
+def percentile(samples, fraction):
+    if len(samples) == 0:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def load(port, concurrency, duration, timeout, cookie):
+    '''
+        Runs client threads for duration seconds, each on a fresh connection per request
+        Returns the latencies of successful requests and the number of failures
+    '''
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def client(offset):
+        mine = []
+        failed = 0
+        i = offset
+        while time.monotonic() < stop_at:
+            path = PATHS[i % len(PATHS)]
+            i += 1
+            started = time.perf_counter()
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+                conn.request('GET', path, headers={'Cookie': cookie})
+                res = conn.getresponse()
+                res.read()
+                conn.close()
+                if res.status >= 500:
+                    failed += 1
+                    continue
+                mine.append(time.perf_counter() - started)
+            except OSError:
+                failed += 1
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0]
+
+
+def run_mode(mode, database, stream_counts, concurrency, duration, timeout):
+    cookie = session_cookie(database)
+    process, port = start_server(mode, database)
+    results = []
+    try:
+        for count in stream_counts:
+            streams = open_streams(port, count, cookie)
+            time.sleep(0.5)
+            latencies, errors = load(port, concurrency, duration, timeout, cookie)
+            for sock in streams:
+                sock.close()
+
+            p50 = percentile(latencies, 0.50)
+            p99 = percentile(latencies, 0.99)
+            results.append({
+                'mode': mode,
+                'idle_streams': count,
+                'concurrency': concurrency,
+                'requests': len(latencies),
+                'errors': errors,
+                'requests_per_sec': round(len(latencies) / duration, 1),
+                'p50_ms': round(p50 * 1000, 2) if p50 is not None else None,
+                'p99_ms': round(p99 * 1000, 2) if p99 is not None else None,
+            })
+            time.sleep(0.5)
+    finally:
+        stop_server(process)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', default=['gunicorn', 'async'], choices=['gunicorn', 'async'])
+    parser.add_argument('--streams', nargs='+', type=int, default=[0, 20], help='idle chat streams to hold open')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per run')
+    parser.add_argument('--timeout', type=float, default=5.0, help='seconds before a request counts as failed')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args.serve, args.port)
+
+    workdir = tempfile.mkdtemp(prefix='student-talk-bench-')
+    results = []
+    try:
+        for mode in args.modes:
+            database = os.path.join(workdir, mode + '.db')
+            shutil.copy(os.path.join(ROOT, 'project.db'), database)
+            results += run_mode(mode, database, args.streams, args.concurrency, args.duration, args.timeout)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print('{:<10} {:>7} {:>10} {:>8} {:>9} {:>9} {:>7}'.format('mode', 'streams', 'requests', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+    for row in results:
+        print('{mode:<10} {idle_streams:>7} {requests:>10} {requests_per_sec:>8} {p50:>9} {p99:>9} {errors:>7}'.format(
+            p50=str(row['p50_ms']), p99=str(row['p99_ms']), **row))
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+'''
+    Compares no_sql_db's storage modes on a presence sized table
+
+    plain is the original Table, a list of lists searched by zipping every
+    row with its field names. rows is the indexed Table, columns is the
+    same with compact=True. Reports bytes per row as tracemalloc sees it,
+    for the whole table and for its row storage without the indexes, with
+    the values themselves made beforehand so only the table's own overhead
+    is counted, and microseconds per lookup by username
+
+        python benchmarks/storage.py
+        python benchmarks/storage.py --rows 200000 --lookups 5000 --json storage.json
+'''
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import no_sql_db
+
+FIELDS = ("username", "status", "last_seen")
+STATUSES = ["online", "away", "offline"]
+
+
+class PlainTable():
+    '''
+        The Table no_sql_db started with, kept here as the baseline
+    '''
+    def __init__(self, table_name, *table_fields):
+        self.entries = []
+        self.fields = table_fields
+        self.name = table_name
+
+    def create_entry(self, data):
+        if len(data) != len(self.fields):
+            raise ValueError('Wrong number of fields for table')
+        self.entries.append(data)
+
+    def search_table(self, target_field_name, target_value):
+        for entry in self.entries:
+            for field_name, value in zip(self.fields, entry):
+                if target_field_name == field_name and target_value == value:
+                    return entry
+        return None
+
+
+def make_rows(count):
+    return [("user{i}".format(i=i), STATUSES[i % len(STATUSES)], 1700000000 + i) for i in range(count)]
+
+
+def build(mode, rows):
+    if mode == "plain":
+        table = PlainTable("presence", *FIELDS)
+    else:
+        table = no_sql_db.Table("presence", *FIELDS, compact=(mode == "columns"))
+    # Each table gets its own row lists, as it would from a request
+    for row in rows:
+        table.create_entry(list(row))
+    return table
+
+
+def build_store(mode, rows):
+    if mode == "plain":
+        return build(mode, rows)
+    store = (no_sql_db.ColumnStore if mode == "columns" else no_sql_db.RowStore)(len(FIELDS))
+    for row_id, row in enumerate(rows):
+        store.put(row_id, list(row))
+    return store
+
+
+def traced_bytes(function, *args):
+    '''
+        Returns what function allocated and kept, and its result
+    '''
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = function(*args)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+
+def measure(mode, rows, lookups):
+    store_bytes, store = traced_bytes(build_store, mode, rows)
+    del store
+    table_bytes, table = traced_bytes(build, mode, rows)
+
+    # The plain table scans, so it gets fewer lookups to keep the run short
+    count = lookups if mode != "plain" else max(1, lookups // 100)
+    targets = [random.choice(rows)[0] for _ in range(count)]
+    started = time.perf_counter()
+    for username in targets:
+        assert table.search_table("username", username) is not None
+    elapsed = time.perf_counter() - started
+
+    return {
+        "mode": mode,
+        "rows": len(rows),
+        "bytes_per_row": round(table_bytes / len(rows), 1),
+        "store_bytes_per_row": round(store_bytes / len(rows), 1),
+        "lookups": count,
+        "us_per_lookup": round(elapsed / count * 1e6, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--lookups', type=int, default=10000)
+    parser.add_argument('--modes', nargs='+', default=['plain', 'rows', 'columns'], choices=['plain', 'rows', 'columns'])
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    results = [measure(mode, rows, args.lookups) for mode in args.modes]
+
+    print('{:<8} {:>8} {:>10} {:>10} {:>9} {:>11}'.format('mode', 'rows', 'bytes/row', 'store/row', 'lookups', 'us/lookup'))
+    for row in results:
+        print('{mode:<8} {rows:>8} {bytes_per_row:>10} {store_bytes_per_row:>10} {lookups:>9} {us_per_lookup:>11}'.format(**row))
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
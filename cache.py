@@ -0,0 +1,144 @@
+'''
+    Small in-process caches for things that are expensive to rebuild on
+    every request but rarely change
+'''
+import collections
+import threading
+import time
+
+
+class FragmentCache():
+    '''
+        Rendered HTML fragments, each rendered once and then served from
+        memory until it is invalidated or its ttl runs out
+
+        The ttl is a safety net for changes made by other server processes,
+        which can't invalidate this process's copy
+    '''
+    def __init__(self, ttl=None):
+        '''
+            :: ttl :: Seconds a fragment may be served for, None to keep it until invalidated
+        '''
+        self.ttl = ttl
+        self.fragments = {}
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, render):
+        '''
+            Returns the fragment for key, calling render() to build it if needed
+        '''
+        now = time.monotonic()
+        with self.lock:
+            cached = self.fragments.get(key)
+            if cached is not None and (self.ttl is None or now - cached[0] < self.ttl):
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+            generation = self.generations.get(key, 0)
+
+        fragment = render()
+
+        # Don't keep a render that raced with an invalidation, it may be stale
+        with self.lock:
+            if self.generations.get(key, 0) == generation:
+                self.fragments[key] = (now, fragment)
+        return fragment
+
+    def invalidate(self, key):
+        with self.lock:
+            self.fragments.pop(key, None)
+            self.generations[key] = self.generations.get(key, 0) + 1
+
+    def clear(self):
+        with self.lock:
+            for key in self.fragments:
+                self.generations[key] = self.generations.get(key, 0) + 1
+            self.fragments.clear()
+
+
+class LRUCache():
+    '''
+        A bounded map that drops the least recently used entry once it is
+        full, entries older than ttl are treated as missing
+    '''
+    def __init__(self, capacity=1000, ttl=None):
+        '''
+            :: capacity :: Entries kept before the least recently used one is dropped
+            :: ttl :: Seconds an entry may be served for, None to keep it until it is evicted
+        '''
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None and self.ttl is not None and now - cached[0] >= self.ttl:
+                del self.entries[key]
+                cached = None
+            if cached is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return cached[1]
+
+    def peek(self, key, default=None):
+        '''
+            Returns an entry without counting it as a use or a hit
+        '''
+        now = time.monotonic()
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is None or (self.ttl is not None and now - cached[0] >= self.ttl):
+                return default
+            return cached[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            cached = self.entries.pop(key, None)
+        return default if cached is None else cached[1]
+
+    def values(self):
+        with self.lock:
+            return [cached[1] for cached in self.entries.values()]
+
+    def items(self):
+        with self.lock:
+            return [(key, cached[1]) for key, cached in self.entries.items()]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def metrics(self):
+        '''
+            Returns a snapshot of the cache's counters
+        '''
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,181 @@
+'''
+    gzip and brotli for text responses
+
+    Compressor wraps the WSGI app and compresses HTML, CSS, JavaScript and
+    JSON bodies for clients that accept it. Bodies under minimum_size go out
+    as they are, and chat streams are never touched, they have to reach the
+    browser a message at a time
+
+    Pages that come out the same for everyone, like /about, compress to the
+    same bytes every time, so compressed bodies are kept in an LRU keyed by
+    a digest of the uncompressed body
+
+    brotli is used when it is installed, 'pip install brotli', otherwise gzip
+'''
+import gzip
+import hashlib
+
+import cache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Best first
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+COMPRESSIBLE_TYPES = ("text/html", "text/css", "text/plain", "text/javascript", "application/javascript",
+    "application/json", "image/svg+xml")
+
+
+def compressible(content_type):
+    return content_type.split(";", 1)[0].strip().lower() in COMPRESSIBLE_TYPES
+
+
+def choose_encoding(accept_encoding, offered=ENCODINGS):
+    '''
+        Returns the best of offered the client accepts, or None
+
+        :: accept_encoding :: The Accept-Encoding header, e.g. 'gzip, deflate, br;q=0.9'
+    '''
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    for encoding in offered:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compress(data, encoding, level=6):
+    '''
+        :: level :: 1-9, mapped onto brotli's 0-11 for br
+    '''
+    if encoding == "br":
+        return brotli.compress(data, quality=min(11, level + 2))
+    # mtime=0 so the same body always compresses to the same bytes
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def weak_etag(etag):
+    '''
+        A compressed body isn't byte for byte the one the ETag was made for
+        bottle's static_file sends unquoted ETags, those are left alone
+    '''
+    return "W/" + etag if etag.startswith('"') else etag
+
+
+def strong_etags(if_none_match):
+    '''
+        If-None-Match compares weakly, so the app sees the ETags it made itself
+    '''
+    return ", ".join(etag.strip()[2:] if etag.strip().startswith("W/") else etag.strip()
+        for etag in if_none_match.split(","))
+
+
+class Compressor():
+    '''
+        WSGI middleware compressing text responses
+    '''
+    def __init__(self, app, minimum_size=1024, level=6, cache_size=128, cache_limit=256 * 1024):
+        '''
+            :: app :: The WSGI app to wrap
+            :: minimum_size :: Bodies shorter than this many bytes aren't worth compressing
+            :: level :: Compression level, 1-9
+            :: cache_size :: Compressed bodies kept
+            :: cache_limit :: Bodies over this many bytes are compressed but not kept
+        '''
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+        self.cache_limit = cache_limit
+        self.cache = cache.LRUCache(cache_size)
+
+    def __call__(self, environ, start_response):
+        encoding = choose_encoding(environ.get("HTTP_ACCEPT_ENCODING"))
+        if encoding is None or environ.get("REQUEST_METHOD") == "HEAD":
+            return self.app(environ, start_response)
+
+        if "HTTP_IF_NONE_MATCH" in environ:
+            environ["HTTP_IF_NONE_MATCH"] = strong_etags(environ["HTTP_IF_NONE_MATCH"])
+
+        started = []
+        def capture(status, headers, exc_info=None):
+            started[:] = [status, headers, exc_info]
+
+        body = self.app(environ, capture)
+
+        # Not started yet, it must be a lazy app, let its response through as it is
+        if len(started) == 0:
+            return self.passthrough(body, started, start_response)
+
+        status, headers, exc_info = started
+        if not self.should_compress(status, headers):
+            start_response(status, headers, exc_info)
+            return body
+
+        try:
+            data = b"".join(body)
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+
+        headers = [(name, value) for name, value in headers if name.lower() not in ("content-length", "vary")] + [
+            ("Vary", self.vary(headers))]
+        if len(data) >= self.minimum_size:
+            data = self.compressed(data, encoding)
+            headers = [(name, weak_etag(value) if name.lower() == "etag" else value) for name, value in headers]
+            headers.append(("Content-Encoding", encoding))
+        headers.append(("Content-Length", str(len(data))))
+        start_response(status, headers, exc_info)
+        return [data]
+
+    def passthrough(self, body, started, start_response):
+        iterator = iter(body)
+        try:
+            for chunk in iterator:
+                if started:
+                    start_response(*started)
+                    started.clear()
+                yield chunk
+            if started:
+                start_response(*started)
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+
+    def should_compress(self, status, headers):
+        code = int(status.split(" ", 1)[0])
+        if code < 200 or code in (204, 206, 304):
+            return False
+        found = dict((name.lower(), value) for name, value in headers)
+        if "content-encoding" in found or "no-transform" in found.get("cache-control", ""):
+            return False
+        return compressible(found.get("content-type", ""))
+
+    def vary(self, headers):
+        existing = [value for name, value in headers if name.lower() == "vary"]
+        if len(existing) == 0:
+            return "Accept-Encoding"
+        return ", ".join(existing + ["Accept-Encoding"])
+
+    def compressed(self, data, encoding):
+        if len(data) > self.cache_limit:
+            return compress(data, encoding, self.level)
+
+        key = (encoding, hashlib.blake2b(data, digest_size=16).digest())
+        encoded = self.cache.get(key)
+        if encoded is None:
+            encoded = compress(data, encoding, self.level)
+            self.cache.put(key, encoded)
+        return encoded
@@ -4,16 +4,132 @@
     maybe some simple program logic
 '''
 
-from bottle import route, get, post, error, request, static_file, response, template
+from bottle import route, get, post, error, hook, request, static_file, response, template, redirect, abort
+
+import json
+import logging
+import mimetypes
+import sys
 
 import model
+import assets
+import metrics
+
+logger = logging.getLogger(__name__)
+
+#-----------------------------------------------------------------------------
+# Request hooks
+#-----------------------------------------------------------------------------
+
+@hook('before_request')
+def start_timer():
+    metrics.request_started()
+
+# Give the database connection back to the pool once the response is built,
+# and record how long the route took and how many statements it ran
+# Requests are grouped by route rule, e.g. '/chat/history', not by full URL
+@hook('after_request')
+def release_connection():
+    model.end_request()
+    route = request.environ.get('bottle.route')
+
+    # Hooks run in a finally block, a route that raised hasn't had its 500 set yet
+    status = 500 if sys.exc_info()[0] is not None else response.status_code
+    metrics.request_finished(request.method, route.rule if route is not None else "unmatched", status)
+
+#-----------------------------------------------------------------------------
+# Sessions
+# Who is making a request comes from their signed session cookie, never
+# from form fields
+#-----------------------------------------------------------------------------
+
+def current_session():
+    '''
+        current_session
+        
+        Returns the Session for this request, or None if it isn't logged in
+    '''
+    return model.get_session(request.get_cookie(model.SESSION_COOKIE))
+
+def require_session():
+    '''
+        require_session
+        
+        Returns the Session for this request, sending the browser to the
+        login page if it isn't logged in
+    '''
+    session = current_session()
+    if session is None:
+        redirect('/login')
+    return session
+
+def require_admin():
+    '''
+        require_admin
+        
+        Returns the admin's Session, sending the browser to the login page
+        if it isn't logged in and refusing anyone else with a 403
+    '''
+    session = require_session()
+    if session.username != 'admin':
+        abort(403, "Only the admin can do that")
+    return session
+
+#-----------------------------------------------------------------------------
+# Conditional GETs
+# Pages built from a user's data carry an ETag made from version counters,
+# a browser that already has the current page gets a 304 and nothing is
+# loaded or rendered
+#-----------------------------------------------------------------------------
+
+def not_modified(etag):
+    '''
+        not_modified
+
+        Sets the page's ETag, returns True if the browser's copy is current
+        The page is private to the signed in user and checked on every use
+    '''
+    if etag is None:
+        return False
+    response.set_header('ETag', etag)
+    response.set_header('Cache-Control', 'private, no-cache')
+    response.set_header('Vary', 'Cookie')
+
+    if_none_match = request.get_header('If-None-Match')
+    if if_none_match is None:
+        return False
+    # If-None-Match compares weakly
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    if '*' not in tags and etag not in [tag[2:] if tag.startswith('W/') else tag for tag in tags]:
+        return False
+    response.status = 304
+    return True
 
 #-----------------------------------------------------------------------------
 # Static file paths
 #-----------------------------------------------------------------------------
-@route('/static/:filename#.*#')
+@route('/static/<filename:path>')
 def send_static(filename):
-    return static_file(filename, root='./static/')
+    '''
+        send_static
+
+        Fingerprinted names never change content, browsers may keep them for good
+        Plain names still work, but are checked for changes on every use
+    '''
+    original = model.static_assets.original(filename)
+    if original is None:
+        return static_file(filename, root='./static/', headers={'Cache-Control': assets.REVALIDATE})
+
+    # Text files were compressed at startup
+    compressed = model.static_assets.compressed(filename, request.get_header('Accept-Encoding'))
+    if compressed is None:
+        return static_file(original, root='./static/', headers={'Cache-Control': assets.IMMUTABLE})
+    encoding, data = compressed
+    response.content_type = mimetypes.guess_type(original)[0] + '; charset=UTF-8'
+    response.set_header('Content-Encoding', encoding)
+    response.set_header('Vary', 'Accept-Encoding')
+    response.set_header('Cache-Control', assets.IMMUTABLE)
+    return data
 
 #-----------------------------------------------------------------------------
 # Pages
@@ -57,10 +173,32 @@ def post_login():
     # Handle the form processing
     username = request.forms.get('username')
     password = request.forms.get('password')
-    response.set_cookie("sender", username)
 
     # Call the appropriate method
-    return model.login_check(username, password)
+    try:
+        page, token = model.login_check(username, password)
+    except model.PasswordPoolBusy:
+        response.status = 503
+        response.set_header('Retry-After', '1')
+        return model.server_busy("Login failed")
+
+    if token is not None:
+        response.set_cookie(model.SESSION_COOKIE, token, path='/', max_age=model.session_store.lifetime,
+            httponly=True, secure=True, samesite='lax')
+    return page
+
+#-----------------------------------------------------------------------------
+
+# End the session
+@get('/logout')
+def get_logout():
+    '''
+        get_logout
+        
+        Logs out and serves the login page
+    '''
+    response.delete_cookie(model.SESSION_COOKIE, path='/')
+    return model.logout(request.get_cookie(model.SESSION_COOKIE))
 
 #-----------------------------------------------------------------------------
 
@@ -92,95 +230,80 @@ def post_register():
     confirm = request.forms.get('confirm')
     
     # Call the appropriate method
-    return model.register_check(username, password, confirm)
+    try:
+        return model.register_check(username, password, confirm)
+    except model.PasswordPoolBusy:
+        response.status = 503
+        response.set_header('Retry-After', '1')
+        return model.server_busy("Registration failed")
 
 #-----------------------------------------------------------------------------
 # Friend page
 @get('/friend_list')
 def friend_list():
-    username = request.forms.get('user')
-    if username is not None:
-        return model.view_friend_list(username)
-    else:
-        raise ValueError("No username provided")
+    session = require_session()
+    if not_modified(model.friend_list_etag(session.username, session)):
+        return ""
+    return model.view_friend_list(session.username, session)
 
 @post('/friend_list')
 def friend_list():
-    user = request.forms.get('user')
-
-    if user is not None:
-        return model.view_friend_list(user)
-    else:
-        raise ValueError("No username provided")
+    session = require_session()
+    return model.view_friend_list(session.username, session)
     
 
 @get('/add_friends')
 def add_friends():
-    username = request.forms.get('user')
-    if username is not None:
-        return model.view_friend_list(username)
-    else:
-        raise ValueError("No username provided")
+    session = require_session()
+    return model.view_friend_list(session.username, session)
 
 @post('/add_friends')
 def add_friends():
-    sender = request.forms.get('sender')
+    session = require_session()
     friend = request.forms.get('friend')
 
-    model.add_friends(sender, friend)
-
-    return model.view_friend_list(sender)
+    return model.add_friends(session.username, friend, session)
 
 @get('/remove_friends')
 def remove_friends():
-    sender = request.forms.get('sender')
+    session = require_session()
     friend = request.forms.get('friend')
 
-    model.remove_friends(sender, friend)
-
-    return model.view_friend_list(sender)
+    return model.remove_friends(session.username, friend, session)
 
 @post('/remove_friends')
 def remove_friends():
-    sender = request.forms.get('sender')
+    session = require_session()
     friend = request.forms.get('friend')
 
-    model.remove_friends(sender, friend)
-
-    return model.view_friend_list(sender)
+    return model.remove_friends(session.username, friend, session)
 
 @post('/todo')
 def todo():
-    user = request.forms.get('sender')
+    session = require_session()
     todo = request.forms.get('todo')
 
-    print("user: ", user)
-    print("todo: ", todo)
+    logger.debug("Adding todo %r for %s", todo, session.username)
 
-    model.add_todo_item(user, todo)
-    return model.view_friend_list(user)
+    return model.add_todo_item(session.username, todo, session)
 
 @post('/remove_todo')
 def remove_todo():
-    print("FROM CONTROLLER REMOVE TODO: ", request.forms.get('todo'))
-    user = request.forms.get('user')
+    session = require_session()
     todo = request.forms.get('todo')
-    model.delete_todo_item(user, todo)
-    return model.view_friend_list(user)
+    return model.delete_todo_item(session.username, todo, session)
 
 @get('/todo')
 def todo():
-    user = request.forms.get('sender')
+    session = require_session()
     todo = request.forms.get('todo')
-    model.add_todo_item(user, todo)
-    return model.view_friend_list(user)
+    return model.add_todo_item(session.username, todo, session)
 
 @get('/remove_todo')
 def remove_todo():
-    user = request.forms.get('user')
+    session = require_session()
     todo = request.forms.get('todo')
-    model.delete_todo_item(user, todo)
-    return model.view_friend_list(user)
+    return model.delete_todo_item(session.username, todo, session)
 
 #-----------------------------------------------------------------------------
 # Chat page
@@ -191,9 +314,95 @@ def get_chat():
         
         Serves the chat page
     '''
-    username = request.forms.get('user')
-    friend = request.forms.get('friend')
-    return model.view_chat(username, friend)
+    session = require_session()
+    friend = request.query.get('friend')
+    if friend is not None and not_modified(model.chat_etag(session.username, friend)):
+        return ""
+    return model.view_chat(session.username, friend)
+
+@get('/chat/history')
+def get_chat_history():
+    '''
+        get_chat_history
+        
+        Serves a page of older messages as an HTML fragment
+        Expects 'friend' and 'before' query parameters
+    '''
+    session = current_session()
+    friend = request.query.get('friend')
+    before = request.query.get('before', '')
+
+    if session is None:
+        response.status = 401
+        return ""
+    if friend is None or not before.isdigit():
+        response.status = 400
+        return ""
+    return model.older_messages(session.username, friend, int(before))
+
+@get('/chat/stream')
+def get_chat_stream():
+    '''
+        get_chat_stream
+        
+        Streams new chat messages as Server-Sent Events
+        Expects 'friend' and 'after' query parameters, a reconnecting
+        EventSource sends its Last-Event-ID header in place of 'after'
+        Each response is a long poll, it ends after the first messages or
+        model.LONG_POLL_LIFETIME seconds and EventSource reconnects
+        Past model.LONG_POLL_LIMIT open streams it answers 503
+    '''
+    session = current_session()
+    friend = request.query.get('friend')
+    after = request.get_header('Last-Event-ID') or request.query.get('after', '0')
+
+    if session is None:
+        response.status = 401
+        return ""
+    if friend is None or not after.isdigit():
+        response.status = 400
+        return ""
+
+    try:
+        events = model.chat_events(session.username, friend, int(after))
+    except model.StreamsBusy:
+        response.status = 503
+        response.set_header('Retry-After', str(model.STREAM_RETRY))
+        response.content_type = 'text/event-stream'
+        return "retry: {delay}\n\n".format(delay=model.STREAM_RETRY * 1000)
+    if events is None:
+        response.status = 404
+        return ""
+
+    response.content_type = 'text/event-stream'
+    response.set_header('Cache-Control', 'no-cache')
+    response.set_header('X-Accel-Buffering', 'no')
+    return events
+
+@post('/chat/send')
+def post_chat_send():
+    '''
+        post_chat_send
+        
+        Stores a chat message without sending a page back, the sender's
+        chat stream delivers it
+        Expects a form containing 'message' and 'receiver' fields
+    '''
+    session = current_session()
+    message = request.forms.get('message')
+    receiver = request.forms.get('receiver')
+
+    if session is None:
+        response.status = 401
+        return ""
+    if not message or receiver is None:
+        response.status = 400
+        return ""
+    if not model.post_message(message, session.username, receiver):
+        response.status = 404
+        return ""
+    response.status = 204
+    return ""
 
 @post('/chat')
 def post_chat():
@@ -203,17 +412,60 @@ def post_chat():
         Handles chat messages
         Expects a form containing 'text' field
     '''
+    sender = require_session().username
     message = request.forms.get('message')
-    sender = request.forms.get('sender')
     receiver = request.forms.get('receiver')
     public_key = request.forms.get('public_key')
     
-    print("sender: ", sender)
-    print("receiver: ", receiver)
+    logger.debug("Chat from %s to %s", sender, receiver)
     if message == None:
         return model.view_chat(sender, receiver)
     return model.send_message(message, sender, receiver)
 
+#-----------------------------------------------------------------------------
+# Message search
+@get('/search')
+def get_search():
+    '''
+        get_search
+        
+        Searches the messages in the user's chats
+        Expects a 'q' query parameter, and optionally 'page'
+    '''
+    session = require_session()
+    page = request.query.get('page', '1')
+    return model.search_messages(session.username, request.query.getunicode('q', ''), int(page) if page.isdigit() else 1)
+
+#-----------------------------------------------------------------------------
+# Guide catalogue
+@get('/guides')
+def get_guides():
+    '''
+        get_guides
+        
+        Serves a page of the course guides
+        Takes an optional 'q' query parameter to search them, and 'page'
+    '''
+    session = require_session()
+    page = request.query.get('page', '1')
+    return model.guides_catalogue(session.username, request.query.getunicode('q', ''), int(page) if page.isdigit() else 1)
+
+@get('/guides/autocomplete')
+def get_guides_autocomplete():
+    '''
+        get_guides_autocomplete
+        
+        Serves the course codes starting with the 'prefix' query parameter as JSON
+    '''
+    if current_session() is None:
+        response.status = 401
+        return ""
+    response.content_type = 'application/json'
+    response.set_header('Cache-Control', 'private, max-age=60')
+    return json.dumps(model.autocomplete_guides(request.query.getunicode('prefix', '')))
+
+#-----------------------------------------------------------------------------
+# Admin pages
 @get('/admin')
 def get_admin():
     '''
@@ -221,6 +473,7 @@ def get_admin():
         
         Serves the admin page
     '''
+    require_admin()
     return model.admin()
 
 @post('/add_guide')
@@ -231,6 +484,7 @@ def add_guide():
         Handles adding a guide
         Expects a form containing 'course code', 'course name' and 'description' fields
     '''
+    require_admin()
     code = request.forms.get('course_code')
     name = request.forms.get('course_name')
     description = request.forms.get('description')
@@ -245,6 +499,7 @@ def remove_guide():
         Handles removing a guide
         Expects a form containing 'course code' field
     '''
+    require_admin()
     code = request.forms.get('course_code')
     return model.remove_guide(code)
 
@@ -256,6 +511,7 @@ def remove_user():
         Handles removing a user
         Expects a form containing 'username' field
     '''
+    require_admin()
     username = request.forms.get('username')
     return model.remove_user(username)
 
@@ -267,9 +523,78 @@ def mute_user():
         Handles muting a user
         Expects a form containing 'username' field
     '''
+    require_admin()
     username = request.forms.get('username')
     return model.mute_user(username)
 
+#-----------------------------------------------------------------------------
+# Bulk admin
+# Each takes a CSV or JSON file in a 'file' form field, or as the raw request
+# body, and answers with a JSON report of what happened to every row
+#-----------------------------------------------------------------------------
+
+def read_upload():
+    '''
+        read_upload
+        
+        Returns the (filename, bytes) of the uploaded file
+    '''
+    upload = request.files.get('file')
+    if upload is not None:
+        return upload.filename, upload.file.read()
+
+    filename = 'upload.json' if 'json' in request.content_type else 'upload.csv'
+    return filename, request.body.read()
+
+def run_bulk(operation):
+    filename, data = read_upload()
+    try:
+        return operation(filename, data)
+    except ValueError as error:
+        response.status = 400
+        return {"error": str(error)}
+
+@post('/bulk/add_guides')
+def bulk_add_guides():
+    '''
+        bulk_add_guides
+        
+        Adds many guides at once
+        Rows need 'course_code', 'course_name' and 'course_description'
+    '''
+    require_admin()
+    return run_bulk(model.bulk_add_guides)
+
+@post('/bulk/remove_guides')
+def bulk_remove_guides():
+    '''
+        bulk_remove_guides
+        
+        Removes many guides at once, rows need a 'course_code'
+    '''
+    require_admin()
+    return run_bulk(model.bulk_remove_guides)
+
+@post('/bulk/remove_users')
+def bulk_remove_users():
+    '''
+        bulk_remove_users
+        
+        Removes many users at once, rows need a 'username'
+    '''
+    require_admin()
+    return run_bulk(model.bulk_remove_users)
+
+@post('/bulk/mute_users')
+def bulk_mute_users():
+    '''
+        bulk_mute_users
+        
+        Mutes many users at once, rows need a 'username'
+    '''
+    require_admin()
+    return run_bulk(model.bulk_mute_users)
+
 #-----------------------------------------------------------------------------
 
 # Display the about page
@@ -294,6 +619,17 @@ def get_contact():
 
 #-----------------------------------------------------------------------------
 
+# Request, query and render timings for Prometheus to scrape
+@get('/metrics')
+def get_metrics():
+    '''
+        get_metrics
+        
+        Serves the metrics in Prometheus' text format
+    '''
+    response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return model.render_metrics()
+
 # Help with debugging
 @post('/debug/<cmd:path>')
 def post_debug(cmd):
@@ -0,0 +1,170 @@
+'''
+    An in-process publish/subscribe hub
+    Chat streams subscribe to a conversation and get each new message pushed
+    to them as soon as it is stored
+
+    Every subscriber has its own bounded queue, a subscriber that stops
+    reading is evicted once its queue fills up rather than holding up
+    publishers or growing without limit
+
+    This only reaches subscribers in the same process, chat streams also
+    poll the database now and then to pick up messages from other workers
+'''
+import asyncio
+import queue
+import threading
+
+# Handed to an evicted subscriber in place of its backlog
+EVICTED = object()
+
+
+class Subscription():
+    '''
+        One subscriber's queue of published items
+    '''
+    def __init__(self, hub, topic, maxsize):
+        self.hub = hub
+        self.topic = topic
+        self.queue = queue.Queue(maxsize)
+        self.evicted = False
+
+    def deliver(self, item):
+        '''
+            Queues an item without blocking, returns False if the queue is full
+        '''
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            return False
+
+    def evict(self):
+        '''
+            Drops the backlog and tells the reader it has been evicted
+        '''
+        self.evicted = True
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        self.deliver(EVICTED)
+
+    def get(self, timeout=None):
+        '''
+            Waits for the next item, returns None on timeout and EVICTED if
+            this subscriber fell too far behind
+        '''
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class AsyncSubscription(Subscription):
+    '''
+        A subscription read from an asyncio event loop
+        Publishers on other threads hand items over with call_soon_threadsafe
+    '''
+    def __init__(self, hub, topic, maxsize, loop):
+        self.hub = hub
+        self.topic = topic
+        self.maxsize = maxsize
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.evicted = False
+
+        # Items handed to the loop but not read yet, the asyncio queue itself is unbounded
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def deliver(self, item):
+        with self.lock:
+            if self.pending >= self.maxsize:
+                return False
+            self.pending += 1
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+        return True
+
+    def evict(self):
+        self.evicted = True
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, EVICTED)
+
+    async def get(self, timeout=None):
+        '''
+            Waits for the next item, returns None on timeout and EVICTED if
+            this subscriber fell too far behind
+        '''
+        try:
+            item = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+        if item is EVICTED:
+            return item
+        with self.lock:
+            self.pending -= 1
+        return item if not self.evicted else EVICTED
+
+
+class MessageHub():
+    '''
+        Fans published items out to every subscriber of a topic
+    '''
+    def __init__(self, queue_size=100):
+        '''
+            :: queue_size :: Items a subscriber may fall behind before it is evicted
+        '''
+        self.queue_size = queue_size
+        self.topics = {}
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+    def subscribe(self, topic, queue_size=None, loop=None):
+        '''
+            Returns a new Subscription to a topic, close it when done
+            Pass an asyncio loop to get an AsyncSubscription read from that loop
+        '''
+        if loop is not None:
+            subscription = AsyncSubscription(self, topic, queue_size or self.queue_size, loop)
+        else:
+            subscription = Subscription(self, topic, queue_size or self.queue_size)
+        with self.lock:
+            self.topics.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscribers = self.topics.get(subscription.topic)
+            if subscribers is None:
+                return
+            subscribers.discard(subscription)
+            if len(subscribers) == 0:
+                del self.topics[subscription.topic]
+
+    def publish(self, topic, item):
+        '''
+            Hands an item to every subscriber of a topic
+            Returns the number of subscribers it reached
+        '''
+        with self.lock:
+            subscribers = list(self.topics.get(topic, ()))
+
+        delivered = 0
+        for subscription in subscribers:
+            if subscription.deliver(item):
+                delivered += 1
+            else:
+                self.unsubscribe(subscription)
+                subscription.evict()
+                self.evictions += 1
+        return delivered
+
+    def subscriber_count(self, topic=None):
+        with self.lock:
+            if topic is not None:
+                return len(self.topics.get(topic, ()))
+            return sum(len(subscribers) for subscribers in self.topics.values())
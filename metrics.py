@@ -0,0 +1,233 @@
+'''
+    Request, SQL and template timings, served on /metrics in Prometheus'
+    text format
+
+    Histograms are kept in memory per server process. controller.py's
+    request hooks time every route and count the statements each request
+    runs, instrument_database() and instrument_view() time queries and page
+    renders, and anything that already keeps its own counters (caches, the
+    password pool) is read when /metrics is scraped through function()
+'''
+import bisect
+import threading
+import time
+
+import sql
+
+# Upper bounds in seconds, from a cached query up to a slow login
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Statements per request
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+PREFIX = "student_talk_"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join('{name}="{value}"'.format(name=name, value=escape(value)) for name, value in labels) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Histogram():
+    '''
+        Counts observations into cumulative buckets, per set of label values
+    '''
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+
+        # label values -> [count in each bucket plus one past the last, sum, count]
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self.series[label_values] = series
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ["# HELP {name} {help}".format(name=self.name, help=self.help),
+            "# TYPE {name} histogram".format(name=self.name)]
+        with self.lock:
+            series = [(label_values, list(counts), total, count) for label_values, (counts, total, count) in self.series.items()]
+
+        for label_values, counts, total, count in sorted(series):
+            labels = list(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, seen in zip(self.buckets + (float("inf"),), counts):
+                cumulative += seen
+                lines.append("{name}_bucket{labels} {value}".format(name=self.name,
+                    labels=format_labels(labels + [("le", format_value(float(bound)))]), value=cumulative))
+            lines.append("{name}_sum{labels} {value}".format(name=self.name, labels=format_labels(labels), value=format_value(total)))
+            lines.append("{name}_count{labels} {value}".format(name=self.name, labels=format_labels(labels), value=count))
+        return lines
+
+
+class Function():
+    '''
+        A counter or gauge read from somewhere else when it is scraped
+    '''
+    def __init__(self, name, kind, help_text, read):
+        '''
+            :: kind :: "counter" or "gauge"
+            :: read :: Returns a number, or a list of (labels dict, number)
+        '''
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.read = read
+
+    def render(self):
+        lines = ["# HELP {name} {help}".format(name=self.name, help=self.help),
+            "# TYPE {name} {kind}".format(name=self.name, kind=self.kind)]
+        value = self.read()
+        samples = value if isinstance(value, list) else [({}, value)]
+        for labels, number in samples:
+            lines.append("{name}{labels} {value}".format(name=self.name, labels=format_labels(sorted(labels.items())),
+                value=format_value(number)))
+        return lines
+
+
+class Registry():
+    '''
+        Everything /metrics reports
+    '''
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        histogram = Histogram(PREFIX + name, help_text, labels, buckets)
+        self.metrics.append(histogram)
+        return histogram
+
+    def function(self, name, kind, help_text, read):
+        self.metrics.append(Function(PREFIX + name, kind, help_text, read))
+
+    def render(self):
+        '''
+            Returns every metric in Prometheus' text exposition format
+        '''
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_seconds = registry.histogram("http_request_duration_seconds",
+    "Time spent in the route handler, streamed bodies aren't included", ["method", "route", "status"])
+request_queries = registry.histogram("http_request_queries",
+    "SQL statements run by each request", ["route"], buckets=COUNT_BUCKETS)
+query_seconds = registry.histogram("sql_query_duration_seconds",
+    "Time to run a named statement, fetching its rows isn't included", ["statement"])
+render_seconds = registry.histogram("template_render_duration_seconds",
+    "Time to render a page template", ["template"])
+
+# The request the calling thread is working on
+local = threading.local()
+
+#-----------------------------------------------------------------------------
+# Requests
+#-----------------------------------------------------------------------------
+
+def request_started():
+    local.started = time.perf_counter()
+    local.queries = 0
+
+
+def request_finished(method, route, status):
+    '''
+        Records the calling thread's request
+
+        :: route :: The route's rule, like '/chat/history', so requests are grouped by route rather than URL
+    '''
+    started = getattr(local, "started", None)
+    if started is None:
+        return
+    local.started = None
+    request_seconds.observe(time.perf_counter() - started, method, route, str(status))
+    request_queries.observe(local.queries, route)
+
+#-----------------------------------------------------------------------------
+# Instrumenting
+#-----------------------------------------------------------------------------
+
+def instrument_database(db):
+    '''
+        Times every named statement db runs and counts them against the current request
+        Messages sent through db's group committer are timed on its writer
+        thread and counted against the request that sent them
+    '''
+    def timed(run):
+        def query(name, params=()):
+            started = time.perf_counter()
+            try:
+                return run(name, params)
+            finally:
+                query_seconds.observe(time.perf_counter() - started, name)
+                local.queries = getattr(local, "queries", 0) + 1
+        return query
+
+    db.query = timed(db.query)
+    db.query_many = timed(db.query_many)
+
+    committer = db.group_committer
+    if committer is None:
+        return
+
+    writer_query = committer.query
+    submit = committer.submit
+
+    def timed_writer_query(cur, name, params=()):
+        started = time.perf_counter()
+        try:
+            return writer_query(cur, name, params)
+        finally:
+            query_seconds.observe(time.perf_counter() - started, name)
+
+    def counted_submit(*args):
+        try:
+            return submit(*args)
+        finally:
+            local.queries = getattr(local, "queries", 0) + sql.MESSAGE_STATEMENTS
+
+    committer.query = timed_writer_query
+    committer.submit = counted_submit
+
+
+def instrument_view(view):
+    '''
+        Times every page view renders
+    '''
+    load_and_render = view.load_and_render
+
+    def timed(filename, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return load_and_render(filename, *args, **kwargs)
+        finally:
+            render_seconds.observe(time.perf_counter() - started, filename)
+
+    view.load_and_render = timed
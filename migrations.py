@@ -0,0 +1,327 @@
+'''
+    Versioned schema migrations for our SQL database
+    The schema version lives in SQLite's own PRAGMA user_version, so
+    upgrading a live project.db only runs the steps it hasn't seen yet
+
+    To change the schema, add a new function at the bottom with the next
+    version number and leave the old ones alone
+'''
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    '''
+        Registers a function as the migration to the given schema version
+
+        :: version :: The schema version this migration upgrades to
+        :: description :: A short summary printed when it runs
+    '''
+    def register(function):
+        MIGRATIONS.append((version, description, function))
+        MIGRATIONS.sort(key=lambda step: step[0])
+        return function
+    return register
+
+
+def current_version(conn):
+    '''
+        Returns the schema version stored in the database
+    '''
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def latest_version():
+    '''
+        Returns the version the newest migration upgrades to
+    '''
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def migrate(conn, target=None):
+    '''
+        Runs every pending migration in order, each in its own transaction
+        If a migration fails it is rolled back and the error is raised
+
+        :: conn :: An open sqlite3 connection
+        :: target :: Stop at this version, defaults to the latest
+
+        Returns a list of (version, description) for the migrations applied
+    '''
+    target = latest_version() if target is None else target
+    applied = []
+
+    for version, description, function in MIGRATIONS:
+        if version <= current_version(conn) or version > target:
+            continue
+
+        cur = conn.cursor()
+        try:
+            cur.execute("BEGIN")
+            function(cur)
+            # PRAGMA doesn't take parameters, version is always one of our own ints
+            cur.execute("PRAGMA user_version = {version}".format(version=int(version)))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+        applied.append((version, description))
+
+    return applied
+
+
+def rebuild_table(cur, table, create_sql, copy_sql):
+    '''
+        Swaps a table for a new definition while keeping its rows
+        Follows SQLite's create, copy, drop, rename recipe
+
+        :: table :: The name of the table to rebuild
+        :: create_sql :: CREATE TABLE statement for a table named {table}_new
+        :: copy_sql :: INSERT INTO {table}_new ... SELECT ... FROM {table}
+    '''
+    cur.execute(create_sql)
+    cur.execute(copy_sql)
+    cur.execute("DROP TABLE {table}".format(table=table))
+    cur.execute("ALTER TABLE {table}_new RENAME TO {table}".format(table=table))
+
+#-----------------------------------------------------------------------------
+# Migrations
+#-----------------------------------------------------------------------------
+
+@migration(1, "Base tables")
+def base_tables(cur):
+    # The original schema, databases created before migrations already have these
+    cur.execute("""CREATE TABLE IF NOT EXISTS Users(
+        username TEXT,
+        password TEXT,
+        admin INTEGER DEFAULT 0
+    )""")
+
+    cur.execute("""CREATE TABLE IF NOT EXISTS Chats(
+        user1 TEXT,
+        user2 TEXT,
+        size INTEGER DEFAULT 0,
+        PRIMARY KEY(user1, user2)
+    )""")
+
+    cur.execute("""CREATE TABLE IF NOT EXISTS Messages(
+        sender TEXT,
+        receiver TEXT,
+        message TEXT,
+        message_index INTEGER,
+        FOREIGN KEY(sender, receiver) REFERENCES Chats(user1, user2),
+        PRIMARY KEY(sender, receiver, message, message_index)
+    )""")
+
+    cur.execute("""CREATE TABLE IF NOT EXISTS Guides(
+        course_code TEXT,
+        course_name TEXT,
+        course_description TEXT,
+        PRIMARY KEY(course_code)
+    )""")
+
+    cur.execute("""CREATE TABLE IF NOT EXISTS Friends(
+        user1 TEXT,
+        user2 TEXT,
+        PRIMARY KEY(user1, user2)
+    )""")
+
+    cur.execute("""CREATE TABLE IF NOT EXISTS Todos(
+        username TEXT,
+        todo TEXT,
+        PRIMARY KEY(username, todo)
+    )""")
+
+
+@migration(2, "Integer keys, conversation ids and reverse indexes")
+def surrogate_keys_and_indexes(cur):
+    # Chats get an integer id that messages point at
+    rebuild_table(cur, "Chats",
+        """CREATE TABLE Chats_new(
+            id INTEGER PRIMARY KEY,
+            user1 TEXT NOT NULL,
+            user2 TEXT NOT NULL,
+            size INTEGER DEFAULT 0,
+            UNIQUE(user1, user2)
+        )""",
+        """INSERT INTO Chats_new(user1, user2, size)
+            SELECT user1, user2, size FROM Chats ORDER BY rowid""")
+    cur.execute("CREATE INDEX Chats_user2 ON Chats(user2)")
+
+    # Messages no longer carry the whole text in their key
+    # Messages whose chat was deleted keep a NULL chat_id
+    rebuild_table(cur, "Messages",
+        """CREATE TABLE Messages_new(
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER REFERENCES Chats(id),
+            sender TEXT,
+            receiver TEXT,
+            message TEXT,
+            message_index INTEGER
+        )""",
+        """INSERT INTO Messages_new(chat_id, sender, receiver, message, message_index)
+            SELECT (
+                SELECT id FROM Chats
+                WHERE (user1 = Messages.sender AND user2 = Messages.receiver)
+                OR (user1 = Messages.receiver AND user2 = Messages.sender)
+            ), sender, receiver, message, message_index
+            FROM Messages ORDER BY rowid""")
+    cur.execute("CREATE INDEX Messages_chat ON Messages(chat_id, message_index)")
+
+    rebuild_table(cur, "Guides",
+        """CREATE TABLE Guides_new(
+            id INTEGER PRIMARY KEY,
+            course_code TEXT NOT NULL UNIQUE,
+            course_name TEXT,
+            course_description TEXT
+        )""",
+        """INSERT INTO Guides_new(course_code, course_name, course_description)
+            SELECT course_code, course_name, course_description FROM Guides ORDER BY rowid""")
+
+    rebuild_table(cur, "Todos",
+        """CREATE TABLE Todos_new(
+            id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL,
+            todo TEXT NOT NULL,
+            UNIQUE(username, todo)
+        )""",
+        """INSERT INTO Todos_new(username, todo)
+            SELECT username, todo FROM Todos ORDER BY rowid""")
+
+    # The (user1, user2) key already covers lookups by user1
+    cur.execute("CREATE INDEX Friends_user2 ON Friends(user2)")
+    cur.execute("CREATE INDEX Users_username ON Users(username)")
+
+
+@migration(3, "Canonical conversation order for Chats")
+def canonical_chats(cur):
+    # A conversation is stored once, with user1 < user2
+    # Chats that somehow exist in both orders are merged into the canonical one
+    duplicates = cur.execute("""
+        SELECT flipped.id, flipped.size, canonical.id, canonical.size
+        FROM Chats flipped
+        JOIN Chats canonical ON canonical.user1 = flipped.user2 AND canonical.user2 = flipped.user1
+        WHERE flipped.user1 > flipped.user2
+    """).fetchall()
+
+    for flipped_id, flipped_size, canonical_id, canonical_size in duplicates:
+        cur.execute("UPDATE Messages SET chat_id = ?, message_index = message_index + ? WHERE chat_id = ?",
+            [canonical_id, canonical_size, flipped_id])
+        cur.execute("UPDATE Chats SET size = size + ? WHERE id = ?", [flipped_size, canonical_id])
+        cur.execute("DELETE FROM Chats WHERE id = ?", [flipped_id])
+
+    # The right hand side sees the old values, so this swaps the pair
+    cur.execute("UPDATE Chats SET user1 = user2, user2 = user1 WHERE user1 > user2")
+
+
+@migration(4, "Sessions and settings")
+def sessions(cur):
+    # Signed in users, ids are random and the cookie carries them signed
+    cur.execute("""CREATE TABLE Sessions(
+        id TEXT PRIMARY KEY,
+        username TEXT NOT NULL,
+        expires REAL NOT NULL
+    )""")
+    cur.execute("CREATE INDEX Sessions_username ON Sessions(username)")
+    cur.execute("CREATE INDEX Sessions_expires ON Sessions(expires)")
+
+    # Server wide values every process needs to agree on
+    cur.execute("""CREATE TABLE Settings(
+        name TEXT PRIMARY KEY,
+        value BLOB
+    )""")
+    cur.execute("INSERT INTO Settings(name, value) VALUES('session_secret', randomblob(32))")
+
+
+@migration(5, "Data versions for conditional GETs")
+def versions(cur):
+    # Counters that go up whenever what a page shows changes, pages use
+    # them as ETags. 'user:<username>' covers a user's friends and todos,
+    # 'guides' the course guides. A missing row is version 0
+    cur.execute("""CREATE TABLE Versions(
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL
+    )""")
+
+    # Kept up by triggers so every writer, including bulk admin changes
+    # and other server processes, bumps them
+    bump = """INSERT INTO Versions(name, version) VALUES({name}, 1)
+        ON CONFLICT(name) DO UPDATE SET version = version + 1"""
+    triggers = [
+        ("Friends", "INSERT", "'user:' || NEW.user1"),
+        ("Friends", "DELETE", "'user:' || OLD.user1"),
+        ("Todos", "INSERT", "'user:' || NEW.username"),
+        ("Todos", "DELETE", "'user:' || OLD.username"),
+        ("Guides", "INSERT", "'guides'"),
+        ("Guides", "UPDATE", "'guides'"),
+        ("Guides", "DELETE", "'guides'"),
+    ]
+    for table, event, name in triggers:
+        cur.execute("""CREATE TRIGGER {table}_version_{suffix} AFTER {event} ON {table}
+            BEGIN {bump}; END""".format(table=table, suffix=event.lower(), event=event, bump=bump.format(name=name)))
+
+
+@migration(6, "Full-text search over messages")
+def message_search(cur):
+    # An external content FTS5 index, the text stays in Messages only
+    # chat_id is indexed too, so a search can be limited to the caller's
+    # conversations inside the index rather than by filtering every hit
+    cur.execute("""CREATE VIRTUAL TABLE MessagesFTS USING fts5(
+        message,
+        chat_id,
+        content='Messages',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""")
+
+    # Every insert, edit and delete of a message reaches the index,
+    # whether it comes from add_message, the group committer or remove_user
+    cur.execute("""CREATE TRIGGER Messages_search_insert AFTER INSERT ON Messages BEGIN
+        INSERT INTO MessagesFTS(rowid, message, chat_id) VALUES(NEW.id, NEW.message, NEW.chat_id);
+    END""")
+    cur.execute("""CREATE TRIGGER Messages_search_delete AFTER DELETE ON Messages BEGIN
+        INSERT INTO MessagesFTS(MessagesFTS, rowid, message, chat_id) VALUES('delete', OLD.id, OLD.message, OLD.chat_id);
+    END""")
+    cur.execute("""CREATE TRIGGER Messages_search_update AFTER UPDATE OF message, chat_id ON Messages BEGIN
+        INSERT INTO MessagesFTS(MessagesFTS, rowid, message, chat_id) VALUES('delete', OLD.id, OLD.message, OLD.chat_id);
+        INSERT INTO MessagesFTS(rowid, message, chat_id) VALUES(NEW.id, NEW.message, NEW.chat_id);
+    END""")
+
+    # Index what is already there
+    cur.execute("INSERT INTO MessagesFTS(MessagesFTS) VALUES('rebuild')")
+
+
+@migration(7, "Full-text search over course guides")
+def guide_search(cur):
+    # External content like MessagesFTS, the text stays in Guides
+    # Prefix autocomplete on course codes uses the course_code UNIQUE index instead
+    cur.execute("""CREATE VIRTUAL TABLE GuidesFTS USING fts5(
+        course_code,
+        course_name,
+        course_description,
+        content='Guides',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )""")
+
+    # add_course_guide, remove_course_guide and the bulk versions all reach the index through these
+    cur.execute("""CREATE TRIGGER Guides_search_insert AFTER INSERT ON Guides BEGIN
+        INSERT INTO GuidesFTS(rowid, course_code, course_name, course_description)
+            VALUES(NEW.id, NEW.course_code, NEW.course_name, NEW.course_description);
+    END""")
+    cur.execute("""CREATE TRIGGER Guides_search_delete AFTER DELETE ON Guides BEGIN
+        INSERT INTO GuidesFTS(GuidesFTS, rowid, course_code, course_name, course_description)
+            VALUES('delete', OLD.id, OLD.course_code, OLD.course_name, OLD.course_description);
+    END""")
+    cur.execute("""CREATE TRIGGER Guides_search_update AFTER UPDATE ON Guides BEGIN
+        INSERT INTO GuidesFTS(GuidesFTS, rowid, course_code, course_name, course_description)
+            VALUES('delete', OLD.id, OLD.course_code, OLD.course_name, OLD.course_description);
+        INSERT INTO GuidesFTS(rowid, course_code, course_name, course_description)
+            VALUES(NEW.id, NEW.course_code, NEW.course_name, NEW.course_description);
+    END""")
+
+    cur.execute("INSERT INTO GuidesFTS(GuidesFTS) VALUES('rebuild')")
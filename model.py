@@ -5,18 +5,50 @@
     It should exist as a separate layer to any database or data structure that you might be using
     Nothing here should be stateful, if it's stateful let the database handle it
 '''
+import os
+import csv
+import hashlib
+import html
+import urllib.parse
+import logging
+import io
+import json
 import view
+import assets
 import random
 import sql
+import hub
+import cache
+import passwords
+import sessions
+import metrics
+import time
+import threading
 import bcrypt
 from diffiehellman import DiffieHellman
 
+logger = logging.getLogger(__name__)
+
+# Static files are linked by content hashed URLs so browsers can cache them for good
+# Templates refer to them by name, e.g. ${css_main} for static/css/main.css
+static_assets = assets.Assets("static")
 
 # Initialise our views, all arguments are defaults for the template
-page_view = view.View()
+page_view = view.View(**static_assets.renders())
 
 # Initialize the database
-db = sql.SQLDatabase("project.db")
+# Each server thread checks out its own connection from a pool of this size
+# Set STUDENT_TALK_DB_PROFILE to "fast" to trade crash durability for fewer fsyncs
+# and STUDENT_TALK_DB to serve a different database file
+# Messages sent at the same time share one commit
+db = sql.SQLDatabase(os.environ.get("STUDENT_TALK_DB", "project.db"), pool_size=8, pool_timeout=10.0,
+    profile=os.environ.get("STUDENT_TALK_DB_PROFILE", "durable"), group_commit=True)
+
+# bcrypt runs on its own small pool so a burst of logins can't starve other pages
+# Logins and registrations past the queue limit raise PasswordPoolBusy
+password_pool = passwords.PasswordPool(workers=2, max_queue=16,
+    rounds=int(os.environ.get("STUDENT_TALK_BCRYPT_ROUNDS", "12")))
+PasswordPoolBusy = passwords.PoolBusy
 
 # Uncomment to reset the database
 # hashed_admin_pw = bcrypt.hashpw('admin'.encode('utf-8'), bcrypt.gensalt())
@@ -24,6 +56,103 @@ db = sql.SQLDatabase("project.db")
 
 chats = {}
 
+# Pushes newly stored messages to open chat streams, one topic per chat id
+message_hub = hub.MessageHub(queue_size=100)
+
+def publish_message(chat_id, sender, receiver, message, message_index):
+    message_hub.publish(chat_id, (sender, message, message_index))
+
+db.on("message", publish_message)
+
+# Rendered page fragments that are the same for every user
+# Guide changes made in this process invalidate them straight away, the ttl
+# bounds how long changes made by other server processes take to show up
+fragments = cache.FragmentCache(ttl=60)
+
+db.on("guides", lambda: fragments.invalidate("guides"))
+
+# The guides version the fragment was last checked against, see friend_list_etag()
+guides_version = None
+
+# username -> their Versions row as friend_list_etag() last saw it
+user_versions = {}
+
+# Signed in users, identified by a signed cookie rather than form fields
+# Each session caches its user's friends and todos until they change
+SESSION_COOKIE = "session"
+session_store = sessions.SessionStore(db, lifetime=7 * 24 * 3600, capacity=10000, cache_ttl=60)
+
+db.on("friends", lambda username: session_store.invalidate(username, "friends"))
+db.on("todos", lambda username: session_store.invalidate(username, "todos"))
+
+# Moderation changes other users' friend lists too
+def forget_removed_user(username):
+    session_store.forget_user(username)
+    session_store.invalidate(None, "friends")
+
+db.on("user_removed", forget_removed_user)
+db.on("user_muted", lambda username: session_store.invalidate(None, "friends"))
+
+# Statement and render timings, plus the counters the caches and pools keep
+# themselves, all served on /metrics
+metrics.instrument_database(db)
+metrics.instrument_view(page_view)
+
+def cache_samples(**caches):
+    samples = []
+    for name, counters in caches.items():
+        samples.extend(({"cache": name, "result": result}, counters[result]) for result in ("hits", "misses"))
+    return samples
+
+def password_samples(field):
+    return [({"kind": kind}, stats[field]) for kind, stats in password_pool.metrics()["calls"].items()]
+
+metrics.registry.function("cache_lookups_total", "counter", "Cache lookups by whether they were served from memory",
+    lambda: cache_samples(friend_graph=db.friend_graph.metrics(), sessions=session_store.sessions.metrics(),
+        fragments={"hits": fragments.hits, "misses": fragments.misses}))
+metrics.registry.function("cache_entries", "gauge", "Entries held by each LRU cache",
+    lambda: [({"cache": "friend_graph"}, len(db.friend_graph)), ({"cache": "sessions"}, len(session_store.sessions))])
+metrics.registry.function("cache_evictions_total", "counter", "Entries each LRU cache dropped to stay within capacity",
+    lambda: [({"cache": "friend_graph"}, db.friend_graph.evictions), ({"cache": "sessions"}, session_store.sessions.evictions)])
+metrics.registry.function("password_jobs_in_flight", "gauge", "bcrypt jobs queued or running",
+    lambda: password_pool.in_flight)
+metrics.registry.function("password_jobs_rejected_total", "counter", "bcrypt jobs turned away because the queue was full",
+    lambda: password_pool.rejected)
+metrics.registry.function("password_jobs_total", "counter", "bcrypt jobs run",
+    lambda: password_samples("count"))
+metrics.registry.function("password_wait_seconds_total", "counter", "Time bcrypt jobs spent queued",
+    lambda: password_samples("wait_seconds"))
+metrics.registry.function("password_max_wait_seconds", "gauge", "Longest any bcrypt job has spent queued",
+    lambda: password_samples("max_wait_seconds"))
+metrics.registry.function("password_hash_seconds_total", "counter", "Time bcrypt jobs spent hashing or checking",
+    lambda: password_samples("hash_seconds"))
+metrics.registry.function("chat_stream_subscribers", "gauge", "Open chat streams",
+    lambda: message_hub.subscriber_count())
+metrics.registry.function("chat_long_polls", "gauge", "Chat streams this process is serving as long polls",
+    lambda: long_polls_open)
+metrics.registry.function("group_commits_total", "counter", "Transactions the group committer has made",
+    lambda: db.group_committer.commits if db.group_committer is not None else 0)
+metrics.registry.function("group_commit_messages_total", "counter", "Messages stored through the group committer",
+    lambda: db.group_committer.messages if db.group_committer is not None else 0)
+
+#-----------------------------------------------------------------------------
+# Requests
+#-----------------------------------------------------------------------------
+
+def end_request():
+    '''
+        end_request
+        Hands this thread's database connection back to the pool
+    '''
+    db.release()
+
+def render_metrics():
+    '''
+        render_metrics
+        Returns every metric in Prometheus' text format
+    '''
+    return metrics.registry.render()
+
 #-----------------------------------------------------------------------------
 # Index
 #-----------------------------------------------------------------------------
@@ -52,28 +181,51 @@ def login_form():
 def login_check(username, password):
     '''
         login_check
-        Checks usernames and passwords
+        Checks usernames and passwords, starting a session if they match
 
         :: username :: The username
         :: password :: The password
 
-        Returns either a view for valid credentials, or a view for invalid credentials
+        Returns (view, session token), the token is None for invalid credentials
     '''
 
     user_exists = db.check_username(username)
     subject = "Login failed"
     if not user_exists:
-        return page_view("invalid", subject=subject, reason="Username does not exist")
+        return page_view("invalid", subject=subject, reason="Username does not exist"), None
     
     #hashed_pw = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
     pw_to_check = password.encode('utf-8')
 
-    login = db.check_credentials(username, pw_to_check)
+    login = db.check_credentials(username, pw_to_check, checkpw=password_pool.check)
     
     if login: 
-        return view_friend_list(username)
+        token = session_store.create(username)
+        return view_friend_list(username, session_store.get(token)), token
     else:
-        return page_view("invalid", subject=subject, reason="Incorrect password")
+        return page_view("invalid", subject=subject, reason="Incorrect password"), None
+
+def get_session(token):
+    '''
+        get_session
+        Returns the Session for a session cookie, or None if it isn't valid
+    '''
+    return session_store.get(token)
+
+def logout(token):
+    '''
+        logout
+        Ends a session and returns the login page
+    '''
+    session_store.end(token)
+    return page_view("login")
+
+def server_busy(subject):
+    '''
+        server_busy
+        Returns the view telling the user to try again shortly
+    '''
+    return page_view("invalid", subject=subject, reason="The server is busy right now, please try again in a moment")
 
 #-----------------------------------------------------------------------------
 # Register
@@ -108,7 +260,9 @@ def register_check(username, password, confirm):
     if password != confirm:
         return page_view("invalid", subject=invalid_subject, reason="Passwords do not match")
     
-    hashed_pw = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    # Nothing else holds the connection while bcrypt runs, add_user takes one again
+    end_request()
+    hashed_pw = password_pool.hash(password.encode('utf-8'))
 
     register = db.add_user(username, hashed_pw)
 
@@ -121,25 +275,78 @@ def register_check(username, password, confirm):
 #-----------------------------------------------------------------------------
 # Friends
 #-----------------------------------------------------------------------------
-def view_friend_list(username):
+# The friend list shows only the newest few guides, the rest are on /guides
+FRIEND_LIST_GUIDES = 5
+
+def render_guide(guide):
+    return """
+            <li>
+            <h4>{course_code}: {course_name}</h4>
+            <p>{des}</p>
+            </li>
+        """.format(course_code=html.escape(guide[0]), course_name=html.escape(guide[1] or ""),
+            des=html.escape(guide[2] or ""))
+
+def render_guides():
+    '''
+        render_guides
+        Renders the newest course guides, the friend list serves this from the fragment cache
+    '''
+    return "".join([render_guide(guide) for guide in db.get_latest_guides(FRIEND_LIST_GUIDES)])
+
+def page_etag(kind, username, *versions):
+    '''
+        page_etag
+        Returns an ETag for a user's page from the versions of the data on it
+        Template and static file changes change it too
+    '''
+    parts = [kind, username, page_view.version()] + [str(version) for version in versions]
+    return '"' + hashlib.blake2b("\0".join(parts).encode('utf-8'), digest_size=12).hexdigest() + '"'
+
+def friend_list_etag(username, session=None):
+    '''
+        friend_list_etag
+        Returns the ETag the friend list page would have right now
+
+        Reads two version counters and nothing else. Changes made by other
+        server processes only show up here, so anything cached from before
+        them is dropped as well
+    '''
+    global guides_version
+    user_version, current_guides = db.get_friend_list_versions(username)
+
+    if user_versions.get(username) != user_version:
+        db.refresh_friends(username)
+        user_versions[username] = user_version
+    if session is not None and session.version != user_version:
+        session.invalidate("friends", "todos")
+        session.version = user_version
+    if guides_version != current_guides:
+        fragments.invalidate("guides")
+        guides_version = current_guides
+
+    return page_etag("friend_list", username, user_version, current_guides)
+
+def session_cached(session, key, load):
+    '''
+        session_cached
+        Returns load() through the session's cache, or straight from load() without a session
+    '''
+    if session is None:
+        return load()
+    return session.get(key, load)
+
+def view_friend_list(username, session=None):
     '''
         friend_list
         Returns the view for the friend list page
 
         :: name :: The name of the user
+        :: session :: Their Session, friends and todos are served from its cache
     '''
-    guides = db.get_course_guides()
-    guides_str = ""
-    for guide in guides:
-        guide_str = """
-            <li>
-            <h4>{course_code}: {course_name}</h4>
-            <p>{des}</p>
-            </li>
-        """.format(course_code=guide[0], course_name=guide[1], des=guide[2])
-        guides_str += guide_str
+    guides_str = fragments.get("guides", render_guides)
 
-    todos = db.get_todos(username)
+    todos = session_cached(session, "todos", lambda: db.get_todos(username)) or []
     # if len(todos) != 0:
     #     todos = [" ".join(todo[0].split("#")) for todo in todos]
 
@@ -157,49 +364,100 @@ def view_friend_list(username):
         """.format(user=username, todo=todo[0])
         todos_str += todo_str
 
-    friends = db.get_friends(username)
+    friends = session_cached(session, "friends", lambda: db.get_friends(username)) or []
     friends_str = ""
     for friend in friends:
         friend_str = """
             <li>
-                <form class="input-form" action="/chat" method="post">
-                    <input type="hidden" name="sender" value={sender}> 
-                    <input type="hidden" name="receiver" value={receiver}>
+                <form class="input-form" action="/chat" method="get">
+                    <input type="hidden" name="friend" value={receiver}>
                     <span>{receiver}</span>
                     <input type="submit" class="chat-button" value="Chat"/>
                 </form>
             </li>
-        """.format(sender=username, receiver=friend[0])
+        """.format(receiver=friend[0])
         friends_str += friend_str
     if username == "admin":
         return page_view("friend_list", header="admin_header", sender=username, friends=friends_str, user=username, guides=guides_str, todos=todos_str)
     return page_view("friend_list", header="user_header", sender=username, friends=friends_str, user=username, guides=guides_str, todos=todos_str)
 
-def add_friends(user1, user2):
+# Each mutation writes and then renders the friend list once, for the controller to return
+# The write invalidates the session's cached copy, so the render reloads just what changed
+
+def add_friends(user1, user2, session=None):
+    '''
+        add_friends
+        Adds a friend and returns the updated friend list
+    '''
     db.add_friend(user1, user2)
-    view_friend_list(user1)
+    return view_friend_list(user1, session)
 
-def remove_friends(user1, user2):
+def remove_friends(user1, user2, session=None):
+    '''
+        remove_friends
+        Removes a friend and returns the updated friend list
+    '''
     db.remove_friend(user1, user2)
-    view_friend_list(user1)
+    return view_friend_list(user1, session)
 
-def add_todo_item(username, todo):
+def add_todo_item(username, todo, session=None):
+    '''
+        add_todo_item
+        Adds a todo and returns the updated friend list
+    '''
     db.add_todo(username, todo)
-    view_friend_list(username)
+    return view_friend_list(username, session)
 
-def delete_todo_item(username, todo):
-    print("FROM MODEL, REMOVING TODO: " + todo + " FOR USER: " + username)
+def delete_todo_item(username, todo, session=None):
+    '''
+        delete_todo_item
+        Removes a todo and returns the updated friend list
+    '''
+    logger.debug("Removing todo %r for %s", todo, username)
     db.remove_todo(username, todo)
-    view_friend_list(username)
+    return view_friend_list(username, session)
 
 #-----------------------------------------------------------------------------
 # Chat
 #-----------------------------------------------------------------------------
 
+# How many messages the chat page shows, older ones are loaded on demand
+CHAT_PAGE_SIZE = 50
+
+def render_message(sender, message):
+    return f'<div class="message"><strong>{html.escape(sender)}:</strong> {html.escape(message)}</div>'
+
+def render_chat_page(page):
+    '''
+        render_chat_page
+        Renders a page of messages as HTML
+
+        :: page :: (sender, message, message_index) rows, oldest first
+
+        Returns the HTML, the message_index to load older messages from,
+        which is empty when this page reaches the start of the conversation,
+        and the message_index of the newest message on the page
+    '''
+    messages = "".join([render_message(message[0], message[1]) for message in page])
+    oldest_index = page[0][2] if len(page) == CHAT_PAGE_SIZE else ""
+    newest_index = page[-1][2] if len(page) > 0 else 0
+    return messages, oldest_index, newest_index
+
+def chat_view(username, friend_name, chat_history, oldest_index, newest_index):
+    '''
+        chat_view
+        Returns the chat page around an already rendered history
+        The names are escaped, the page's script reads them back from data- attributes
+    '''
+    header = "admin_header" if username == "admin" else "user_header"
+    return page_view("chat", header=header, message_history=chat_history, oldest_index=oldest_index,
+        newest_index=newest_index, sender=html.escape(username), receiver=html.escape(friend_name), user=username,
+        stream_retry=STREAM_RETRY * 1000)
+
 def view_chat(username, friend_name):
     '''
         chat
-        Returns the view for the chat page
+        Returns the view for the chat page, showing the newest page of messages
 
         :: name :: The name of the user
     '''
@@ -207,19 +465,52 @@ def view_chat(username, friend_name):
         if username == "admin":
             return page_view("invalid", header="admin_header", reason="No username or friend name provided",  user=username)
         return page_view("invalid", header="user_header", reason="No username or friend name provided",  user=username)
-    
-    if not db.chat_exists(username, friend_name) and not db.chat_exists(friend_name, username):
-        db.add_chat(username, friend_name)
-        chat_history = ""
-        print("ADDED CHAT", username, friend_name)
-    else:
-        print("LOADING CHAT" , username, friend_name)
-        chat_history = db.get_chat_history(username, friend_name)
 
-    print("CHAT HISTORY", chat_history)
-    if username == "admin":
-        return page_view("chat", header="admin_header", message_history=chat_history, sender=username, receiver=friend_name, user=username)
-    return page_view("chat", header="user_header", message_history=chat_history, sender=username, receiver=friend_name, user=username)
+    # Looking never starts a conversation, the first message does
+    if db.get_conversation_id(username, friend_name) is None and not can_chat(username, friend_name):
+        header = "admin_header" if username == "admin" else "user_header"
+        return page_view("invalid", header=header, reason="You can only chat with your friends", user=username)
+    logger.debug("Loading chat between %s and %s", username, friend_name)
+    chat_history, oldest_index, newest_index = render_chat_page(db.get_chat_page(username, friend_name, CHAT_PAGE_SIZE))
+    return chat_view(username, friend_name, chat_history, oldest_index, newest_index)
+
+def can_chat(username, friend_name):
+    '''
+        can_chat
+        Returns whether either user has added the other, which a new conversation needs
+    '''
+    return db.are_friends(username, friend_name) or db.are_friends(friend_name, username)
+
+def start_chat(sender, receiver):
+    '''
+        start_chat
+        Makes sure a conversation exists before its first message is stored
+    '''
+    if db.get_conversation_id(sender, receiver) is None and can_chat(sender, receiver):
+        db.get_conversation_id(sender, receiver, create=True)
+
+def chat_etag(username, friend_name):
+    '''
+        chat_etag
+        Returns the ETag the chat page would have right now, or None before the chat exists
+        Only reads the conversation's row in Chats
+    '''
+    version = db.get_chat_version(username, friend_name)
+    if version is None:
+        return None
+    return page_etag("chat", username, friend_name, *version)
+
+def older_messages(username, friend_name, before):
+    '''
+        older_messages
+        Returns the page of messages just before a message_index as an HTML fragment
+        The fragment's data-before attribute is where the next page starts
+
+        :: before :: The message_index of the oldest message already shown
+    '''
+    page = db.get_chat_page(username, friend_name, CHAT_PAGE_SIZE, before=before)
+    messages, oldest_index, _ = render_chat_page(page)
+    return f'<div class="message-page" data-before="{oldest_index}">{messages}</div>'
 
 def send_message(message, sender, receiver):
     '''
@@ -230,14 +521,287 @@ def send_message(message, sender, receiver):
     '''
     # curr_chat = chats[(sender, receiver)] if (sender, receiver) in chats.keys() else chats[(receiver, sender)]
     # curr_chat.add_message(sender, message)
+    start_chat(sender, receiver)
     db.add_message(sender, receiver, message)
-    chat_history = db.get_chat_history(sender, receiver)
-    
-    print("CHAT HISTORY", chat_history)
-    if sender == "admin":
-        return page_view("chat", header="admin_header", message_history=chat_history, sender=sender, receiver=receiver,  user=sender)
-    return page_view("chat", header="user_header", message_history=chat_history, sender=sender, receiver=receiver,  user=sender)
+    chat_history, oldest_index, newest_index = render_chat_page(db.get_chat_page(sender, receiver, CHAT_PAGE_SIZE))
+    return chat_view(sender, receiver, chat_history, oldest_index, newest_index)
 
+def post_message(message, sender, receiver):
+    '''
+        post_message
+        Stores a message without rendering anything, open chat streams pick it up
+
+        Returns False if there is no chat between the two users and they aren't friends
+    '''
+    start_chat(sender, receiver)
+    return db.add_message(sender, receiver, message)
+
+#-----------------------------------------------------------------------------
+# Chat streams
+#-----------------------------------------------------------------------------
+
+# Seconds between keepalives, each one also checks the database for
+# messages stored by other server processes
+STREAM_POLL_INTERVAL = 15
+
+# Streams are closed after this many seconds, EventSource reconnects by itself
+STREAM_LIFETIME = 300
+
+# Streams served by a WSGI worker hold it until they close, so they end as
+# soon as anything has been sent or after this many seconds, well inside
+# gunicorn's 30 second worker timeout. EventSource picks up where it left
+# off through Last-Event-ID
+LONG_POLL_LIFETIME = 20
+
+# Long polls this process serves at once, run.py sets it to a share of its
+# threads so open chat tabs can't take all of them. Past it chat_events()
+# raises StreamsBusy and the page tries again after STREAM_RETRY seconds
+LONG_POLL_LIMIT = 16
+STREAM_RETRY = 5
+
+class StreamsBusy(Exception):
+    '''
+        Raised when LONG_POLL_LIMIT long polls are already open
+    '''
+    pass
+
+long_poll_lock = threading.Lock()
+long_polls_open = 0
+
+def claim_long_poll():
+    global long_polls_open
+    with long_poll_lock:
+        if long_polls_open >= LONG_POLL_LIMIT:
+            return False
+        long_polls_open += 1
+        return True
+
+def release_long_poll():
+    global long_polls_open
+    with long_poll_lock:
+        long_polls_open -= 1
+
+def open_chat_stream(username, friend_name, after, loop=None):
+    '''
+        open_chat_stream
+        Subscribes to a chat and fetches the messages a client has missed
+
+        :: after :: The message_index of the newest message the client has
+        :: loop :: The asyncio loop to deliver on, when serving asynchronously
+
+        Returns (subscription, missed messages), or None if there is no such chat
+    '''
+    chat_id = db.get_conversation_id(username, friend_name)
+    if chat_id is None:
+        return None
+
+    # Subscribe before catching up so nothing stored in between is missed
+    subscription = message_hub.subscribe(chat_id, loop=loop)
+    missed = db.get_chat_page(username, friend_name, CHAT_PAGE_SIZE, after=after)
+    return subscription, missed
+
+def poll_messages(username, friend_name, after):
+    '''
+        poll_messages
+        Fetches messages newer than after, for streams that have been idle
+        The connection goes straight back to the pool so idle streams don't hold one
+    '''
+    try:
+        return db.get_chat_page(username, friend_name, CHAT_PAGE_SIZE, after=after)
+    finally:
+        end_request()
+
+def chat_events(username, friend_name, after):
+    '''
+        chat_events
+        Opens a stream of Server-Sent Events for new messages in a chat
+
+        Returns a generator of event strings, or None if there is no such chat
+        Raises StreamsBusy when this process is already serving LONG_POLL_LIMIT of them
+    '''
+    if not claim_long_poll():
+        raise StreamsBusy("Too many chat streams open, try again shortly")
+
+    try:
+        opened = open_chat_stream(username, friend_name, after)
+    except Exception:
+        release_long_poll()
+        raise
+    if opened is None:
+        release_long_poll()
+        return None
+
+    subscription, missed = opened
+    return stream_events(subscription, username, friend_name, missed, after, lifetime=LONG_POLL_LIFETIME,
+        long_poll=True, on_close=release_long_poll)
+
+def message_event(sender, message, message_index):
+    data = "\n".join("data: " + line for line in render_message(sender, message).splitlines())
+    return f"id: {message_index}\nevent: message\n{data}\n\n"
+
+def stream_events(subscription, username, friend_name, missed, after, lifetime=STREAM_LIFETIME, long_poll=False,
+        on_close=None):
+    '''
+        stream_events
+        Yields the messages a client missed, then new ones as they are published
+        The stream ends when the client goes away, the lifetime runs out or the
+        hub evicts it for falling behind
+
+        :: lifetime :: Seconds before the stream is closed
+        :: long_poll :: End the stream once any message has been sent
+        :: on_close :: Called once the stream has ended
+    '''
+    last_index = after
+    deadline = time.monotonic() + lifetime
+    try:
+        # Tell EventSource how soon to come back once we close
+        yield "retry: 1000\n\n"
+
+        while True:
+            for sender, message, message_index in missed:
+                if message_index > last_index:
+                    last_index = message_index
+                    yield message_event(sender, message, message_index)
+            missed = []
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or (long_poll and last_index > after):
+                return
+
+            item = subscription.get(timeout=min(STREAM_POLL_INTERVAL, remaining))
+            if item is hub.EVICTED:
+                return
+            if item is not None:
+                missed = [item]
+                continue
+
+            # Nothing published here for a while, catch anything other processes stored
+            yield ": keepalive\n\n"
+            missed = poll_messages(username, friend_name, last_index)
+    finally:
+        subscription.close()
+        if on_close is not None:
+            on_close()
+
+
+#-----------------------------------------------------------------------------
+# Message search
+#-----------------------------------------------------------------------------
+
+# Hits per page, and how far back the pages go, every page re-ranks all the hits before it
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGES = 50
+
+# Longer queries are cut down to this many characters
+SEARCH_MAX_LENGTH = 200
+
+def render_search_hit(username, hit):
+    '''
+        render_search_hit
+        Renders one search result, linking to the chat it is in
+
+        :: hit :: A (chat_id, sender, receiver, message_index, snippet) row
+    '''
+    chat_id, sender, receiver, message_index, snippet = hit
+    friend = receiver if sender == username else sender
+    snippet = html.escape(snippet).replace("\x02", "<mark>").replace("\x03", "</mark>")
+    return """
+            <li class="search-hit">
+                <a href="/chat?{link}">{friend}</a>
+                <p><strong>{sender}:</strong> {snippet}</p>
+            </li>
+        """.format(link=urllib.parse.urlencode({"friend": friend}), friend=html.escape(friend),
+            sender=html.escape(sender), snippet=snippet)
+
+def page_link(path, query, page, label):
+    return '<a href="{path}?{link}">{label}</a>'.format(path=path, link=urllib.parse.urlencode({"q": query, "page": page}),
+        label=label)
+
+def search_messages(username, query, page=1):
+    '''
+        search_messages
+        Returns the search page for a page of the messages in username's chats
+        matching query, best match first
+
+        :: query :: Words to look for, a word ending in * matches as a prefix
+        :: page :: Which page of hits to show, from 1
+    '''
+    header = "admin_header" if username == "admin" else "user_header"
+    query = (query or "").strip()[:SEARCH_MAX_LENGTH]
+    page = min(max(page, 1), SEARCH_MAX_PAGES)
+
+    hits = []
+    if query != "":
+        # One extra hit says whether there is a next page
+        hits = db.search_messages(username, query, SEARCH_PAGE_SIZE + 1, (page - 1) * SEARCH_PAGE_SIZE)
+    more = len(hits) > SEARCH_PAGE_SIZE and page < SEARCH_MAX_PAGES
+    hits = hits[:SEARCH_PAGE_SIZE]
+
+    if query == "":
+        summary = ""
+    elif len(hits) == 0:
+        summary = "No messages match"
+    else:
+        first = (page - 1) * SEARCH_PAGE_SIZE + 1
+        summary = "Results {first} to {last}".format(first=first, last=first + len(hits) - 1)
+
+    return page_view("search", header=header, user=username, query=html.escape(query, quote=True), summary=summary,
+        results="".join([render_search_hit(username, hit) for hit in hits]),
+        previous=page_link("/search", query, page - 1, "Previous") if page > 1 and query != "" else "",
+        next=page_link("/search", query, page + 1, "Next") if more else "")
+
+#-----------------------------------------------------------------------------
+# Guide catalogue
+#-----------------------------------------------------------------------------
+
+GUIDES_PAGE_SIZE = 20
+
+# Course codes offered per autocomplete, and the longest prefix looked up
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_MAX_LENGTH = 20
+
+def guides_catalogue(username, query, page=1):
+    '''
+        guides_catalogue
+        Returns the guides page, every guide by course code, or the guides
+        matching query best match first
+
+        :: query :: Words to look for in codes, names and descriptions, the last one as a prefix
+        :: page :: Which page of guides to show, from 1
+    '''
+    header = "admin_header" if username == "admin" else "user_header"
+    query = (query or "").strip()[:SEARCH_MAX_LENGTH]
+    page = min(max(page, 1), SEARCH_MAX_PAGES)
+
+    # One extra guide says whether there is a next page
+    guides = db.search_course_guides(query, GUIDES_PAGE_SIZE + 1, (page - 1) * GUIDES_PAGE_SIZE)
+    more = len(guides) > GUIDES_PAGE_SIZE and page < SEARCH_MAX_PAGES
+    guides = guides[:GUIDES_PAGE_SIZE]
+
+    summary = "No guides match" if len(guides) == 0 else ""
+    return page_view("guides", header=header, user=username, query=html.escape(query, quote=True), summary=summary,
+        guides="".join([render_guide(guide) for guide in guides]),
+        previous=page_link("/guides", query, page - 1, "Previous") if page > 1 else "",
+        next=page_link("/guides", query, page + 1, "Next") if more else "")
+
+def autocomplete_guides(prefix):
+    '''
+        autocomplete_guides
+        Returns [{"course_code": ..., "course_name": ...}] for the first guides whose code starts with prefix
+        Course codes are upper case, so the prefix is too
+    '''
+    prefix = (prefix or "").strip().upper()[:AUTOCOMPLETE_MAX_LENGTH]
+    if prefix == "":
+        return []
+    return [{"course_code": code, "course_name": name}
+        for code, name in db.autocomplete_course_codes(prefix, AUTOCOMPLETE_LIMIT)]
+
+def rebuild_message_search():
+    '''
+        rebuild_message_search
+        Rebuilds the message search index from the Messages table
+    '''
+    db.rebuild_message_search()
 
 #-----------------------------------------------------------------------------
 # Admin
@@ -281,6 +845,114 @@ def mute_user(username):
     db.mute_user(username)
     return page_view("admin", header="admin_header", user="admin")
 #-----------------------------------------------------------------------------
+# Bulk admin
+#-----------------------------------------------------------------------------
+
+GUIDE_FIELDS = ["course_code", "course_name", "course_description"]
+
+# Other names accepted for columns in uploads, matching the admin form's field names
+FIELD_ALIASES = {"description": "course_description", "code": "course_code", "name": "course_name", "user": "username"}
+
+def parse_upload(filename, data, fields):
+    '''
+        parse_upload
+        Reads a CSV or JSON upload into rows of the given fields
+
+        :: filename :: Name of the upload, a .json name (or JSON content) is read as JSON
+        :: data :: The raw upload as bytes
+        :: fields :: The fields to pull out of each row, in order
+
+        JSON can be a list of objects, of lists or of single values
+        CSV can start with a header row naming its columns, otherwise columns are taken in order
+
+        Returns a list of tuples, missing fields are empty strings
+        Raises ValueError if the upload can't be read
+    '''
+    text = data.decode("utf-8-sig")
+    is_json = filename.lower().endswith(".json") or text.lstrip()[:1] in ("[", "{")
+
+    def from_mapping(item):
+        item = dict((FIELD_ALIASES.get(key.strip().lower(), key.strip().lower()), value) for key, value in item.items())
+        return tuple(str(item.get(field) or "").strip() for field in fields)
+
+    def from_sequence(item):
+        item = [str(value).strip() for value in item][:len(fields)]
+        return tuple(item + [""] * (len(fields) - len(item)))
+
+    if is_json:
+        try:
+            items = json.loads(text)
+        except json.JSONDecodeError as error:
+            raise ValueError("Invalid JSON: {error}".format(error=error))
+        if not isinstance(items, list):
+            raise ValueError("JSON uploads must be a list")
+
+        rows = []
+        for item in items:
+            if isinstance(item, dict):
+                rows.append(from_mapping(item))
+            elif isinstance(item, list):
+                rows.append(from_sequence(item))
+            else:
+                rows.append(from_sequence([item]))
+        return rows
+
+    lines = [line for line in csv.reader(io.StringIO(text)) if any(cell.strip() for cell in line)]
+    if len(lines) == 0:
+        return []
+
+    header = [FIELD_ALIASES.get(cell.strip().lower(), cell.strip().lower()) for cell in lines[0]]
+    if fields[0] in header:
+        return [from_mapping(dict(zip(header, line))) for line in lines[1:]]
+    return [from_sequence(line) for line in lines]
+
+def bulk_report(outcomes):
+    '''
+        bulk_report
+        Summarises (key, outcome) pairs from a bulk operation
+    '''
+    counts = {}
+    for _, outcome in outcomes:
+        counts[outcome] = counts.get(outcome, 0) + 1
+
+    return {
+        "total": len(outcomes),
+        "counts": counts,
+        "rows": [{"row": number, "key": key, "outcome": outcome} for number, (key, outcome) in enumerate(outcomes, 1)],
+    }
+
+def bulk_add_guides(filename, data):
+    '''
+        bulk_add_guides
+        Adds every guide in an upload in one transaction, returns the report
+    '''
+    return bulk_report(db.add_course_guides(parse_upload(filename, data, GUIDE_FIELDS)))
+
+def bulk_remove_guides(filename, data):
+    '''
+        bulk_remove_guides
+        Removes every course code in an upload in one transaction, returns the report
+    '''
+    codes = [row[0] for row in parse_upload(filename, data, ["course_code"])]
+    return bulk_report(db.remove_course_guides(codes))
+
+def bulk_remove_users(filename, data):
+    '''
+        bulk_remove_users
+        Removes every username in an upload in one transaction, returns the report
+    '''
+    usernames = [row[0] for row in parse_upload(filename, data, ["username"])]
+    return bulk_report(db.remove_users(usernames))
+
+def bulk_mute_users(filename, data):
+    '''
+        bulk_mute_users
+        Mutes every username in an upload in one transaction, returns the report
+    '''
+    usernames = [row[0] for row in parse_upload(filename, data, ["username"])]
+    return bulk_report(db.mute_users(usernames))
+
+#-----------------------------------------------------------------------------
 # About
 #-----------------------------------------------------------------------------
 
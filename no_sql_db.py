@@ -6,62 +6,352 @@
 # Write a few dispatch methods and add routes
 
 # A heads up, this code is for demonstration purposes; you might want to modify it for your own needs
-# Currently it does basic insertions and lookups
+# It does insertions, lookups, range lookups, updates and deletions
+# Every field gets a hash index, so lookups don't scan the table
+# Values that can't be hashed, like lists, are kept out of the indexes and
+# lookups check those rows one by one
+# Give DB a path and every change is appended to a log file, which is
+# compacted into a snapshot now and then and replayed at startup
+# Big tables can be made compact, storing one list per field instead of one list per row
+
+import bisect
+import itertools
+import json
+import os
+import threading
+
+def hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+class RowStore():
+    '''
+        Keeps each row as its own list, keyed by row id
+    '''
+    def __init__(self, width):
+        self.rows = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def ids(self):
+        return iter(list(self.rows))
+
+    def get(self, row_id):
+        return self.rows[row_id]
+
+    def put(self, row_id, row):
+        self.rows[row_id] = row
+
+    def pop(self, row_id):
+        return self.rows.pop(row_id)
+
+
+class ColumnStore():
+    '''
+        Keeps one list per field, a row is the same position in every list
+
+        A row costs one pointer per field and a byte saying it's alive, against
+        a list object, a dictionary entry and an int per row in RowStore.
+        Rows are built when they're asked for, so they cost more to read
+        Row ids index straight into the lists, so a deleted row leaves a hole
+    '''
+    def __init__(self, width):
+        self.columns = [[] for _ in range(width)]
+        self.alive = bytearray()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def ids(self):
+        return itertools.compress(range(len(self.alive)), bytes(self.alive))
+
+    def get(self, row_id):
+        if row_id >= len(self.alive) or not self.alive[row_id]:
+            raise KeyError(row_id)
+        return [column[row_id] for column in self.columns]
+
+    def put(self, row_id, row):
+        gap = row_id + 1 - len(self.alive)
+        if gap > 0:
+            self.alive.extend(bytes(gap))
+            for column in self.columns:
+                column.extend([None] * gap)
+
+        if not self.alive[row_id]:
+            self.count += 1
+            self.alive[row_id] = 1
+        for column, value in zip(self.columns, row):
+            column[row_id] = value
+
+    def pop(self, row_id):
+        row = self.get(row_id)
+        for column in self.columns:
+            column[row_id] = None
+        self.alive[row_id] = 0
+        self.count -= 1
+        return row
+
 
 class Table():
-    def __init__(self, table_name, *table_fields):
-        self.entries = []
+    def __init__(self, table_name, *table_fields, compact=False):
+        '''
+            :: compact :: Store the table by column, for big tables where memory matters more than read speed
+        '''
         self.fields = table_fields
         self.name = table_name
+        self.compact = compact
+        self.positions = dict((field, position) for position, field in enumerate(table_fields))
+
+        # Row id -> row, ids are handed out in insertion order
+        self.store = (ColumnStore if compact else RowStore)(len(table_fields))
+        self.next_id = 0
+
+        # Field -> value -> row id, or a set of row ids once a value repeats
+        # Most values are unique, and an int is far smaller than a set
+        self.indexes = dict((field, {}) for field in table_fields)
+
+        # Field -> ids of rows whose value for it can't be hashed
+        self.unindexed = dict((field, set()) for field in table_fields)
+
+        # Field -> sorted distinct values, built on the first range lookup after a change
+        self.sorted_values = {}
+
+        # Called with each change so DB can log it
+        self.journal = None
+        self.lock = threading.RLock()
+
+    @property
+    def entries(self):
+        '''
+            Every row in insertion order
+        '''
+        return [self.store.get(row_id) for row_id in self.store.ids()]
+
+    def position(self, field_name):
+        if field_name not in self.positions:
+            raise KeyError("No field '{field}' in table '{table}'".format(field=field_name, table=self.name))
+        return self.positions[field_name]
+
+    def index_row(self, row_id, row):
+        for field, value in zip(self.fields, row):
+            if not hashable(value):
+                self.unindexed[field].add(row_id)
+                continue
+            index = self.indexes[field]
+            ids = index.get(value)
+            if ids is None:
+                index[value] = row_id
+            elif type(ids) is int:
+                index[value] = {ids, row_id}
+            else:
+                ids.add(row_id)
+            self.sorted_values.pop(field, None)
+
+    def unindex_row(self, row_id, row):
+        for field, value in zip(self.fields, row):
+            if row_id in self.unindexed[field]:
+                self.unindexed[field].discard(row_id)
+                continue
+            index = self.indexes[field]
+            ids = index[value]
+            if type(ids) is int:
+                del index[value]
+            else:
+                ids.discard(row_id)
+                if len(ids) == 1:
+                    index[value] = ids.pop()
+            self.sorted_values.pop(field, None)
+
+    @staticmethod
+    def sorted_ids(ids):
+        if ids is None:
+            return []
+        if type(ids) is int:
+            return [ids]
+        return sorted(ids)
+
+    def record(self, op, **details):
+        if self.journal is not None:
+            self.journal(dict(op=op, table=self.name, **details))
+
+    def matching_ids(self, target_field_name, target_value):
+        position = self.position(target_field_name)
+        ids = self.sorted_ids(self.indexes[target_field_name].get(target_value)) if hashable(target_value) else []
+
+        unindexed = [row_id for row_id in self.unindexed[target_field_name]
+            if self.store.get(row_id)[position] == target_value]
+        if len(unindexed) == 0:
+            return ids
+        return sorted(ids + unindexed)
 
     def create_entry(self, data):
         '''
         Inserts an entry in the table
-        Doesn't do any type checking
+        Doesn't do any type checking, values that can't be hashed just aren't indexed
+        Returns the new row's id
         '''
 
         # Bare minimum, we'll check the number of fields
         if len(data) != len(self.fields):
             raise ValueError('Wrong number of fields for table')
 
-        self.entries.append(data)
-        return
+        with self.lock:
+            row_id = self.next_id
+            self.insert_row(row_id, list(data))
+            try:
+                self.record("insert", id=row_id, data=list(data))
+            except Exception:
+                # The log couldn't take it, e.g. a value JSON can't hold, so leave no trace of the row
+                self.remove_row(row_id)
+                self.next_id = row_id
+                raise
+        return row_id
+
+    def insert_row(self, row_id, row):
+        self.store.put(row_id, row)
+        self.next_id = max(self.next_id, row_id + 1)
+        self.index_row(row_id, row)
 
     def search_table(self, target_field_name, target_value):
         '''
             Search the table given a field name and a target value
             Returns the first entry found that matches
         '''
-        # Lazy search for matching entries
-        for entry in self.entries:
-            for field_name, value in zip(self.fields, entry):
-                if target_field_name == field_name and target_value == value:
-                    return entry
+        with self.lock:
+            ids = self.matching_ids(target_field_name, target_value) if target_field_name in self.indexes else []
+            if len(ids) == 0:
+                # Nothing Found
+                return None
+            return self.store.get(ids[0])
+
+    def search_all(self, target_field_name, target_value):
+        '''
+            Returns every entry whose field equals the target value, in insertion order
+        '''
+        with self.lock:
+            return [self.store.get(row_id) for row_id in self.matching_ids(target_field_name, target_value)]
+
+    def range_search(self, target_field_name, low=None, high=None):
+        '''
+            Returns every entry whose field is between low and high inclusive,
+            ordered by that field. Leave either end as None to leave it open
+            The field's values have to be comparable with each other, rows
+            whose value can't be hashed are left out
+        '''
+        with self.lock:
+            self.position(target_field_name)
+            values = self.sorted_values.get(target_field_name)
+            if values is None:
+                values = sorted(self.indexes[target_field_name])
+                self.sorted_values[target_field_name] = values
+
+            start = 0 if low is None else bisect.bisect_left(values, low)
+            end = len(values) if high is None else bisect.bisect_right(values, high)
+
+            index = self.indexes[target_field_name]
+            return [self.store.get(row_id) for value in values[start:end] for row_id in self.sorted_ids(index[value])]
+
+    def update_entries(self, target_field_name, target_value, changes):
+        '''
+            Sets fields on every entry matching the target value
+
+            :: changes :: A dictionary of field name to new value
+
+            Returns the number of entries changed
+        '''
+        positions = [(self.position(field), value) for field, value in changes.items()]
+        with self.lock:
+            ids = self.matching_ids(target_field_name, target_value)
+            for row_id in ids:
+                row = list(self.store.get(row_id))
+                for position, value in positions:
+                    row[position] = value
+                self.replace_row(row_id, row)
+                self.record("update", id=row_id, data=row)
+        return len(ids)
 
-        # Nothing Found
-        return None
+    def replace_row(self, row_id, row):
+        self.unindex_row(row_id, self.store.get(row_id))
+        self.store.put(row_id, row)
+        self.index_row(row_id, row)
+
+    def delete_entries(self, target_field_name, target_value):
+        '''
+            Deletes every entry matching the target value
+            Returns the number of entries deleted
+        '''
+        with self.lock:
+            ids = self.matching_ids(target_field_name, target_value)
+            for row_id in ids:
+                self.remove_row(row_id)
+                self.record("delete", id=row_id)
+        return len(ids)
+
+    def remove_row(self, row_id):
+        self.unindex_row(row_id, self.store.pop(row_id))
+
+    def snapshot(self):
+        return {
+            "fields": list(self.fields),
+            "compact": self.compact,
+            "next_id": self.next_id,
+            "rows": [[row_id, self.store.get(row_id)] for row_id in self.store.ids()],
+        }
 
 
 class DB():
     '''
     This is a singleton class that handles all the tables
-    You'll probably want to extend this with features like multiple lookups, and deletion
-    A method to write to and load from file might also be useful for your purposes
+
+    Without a path everything lives in memory only. With a path every change
+    is appended to the log at path, and once compact_every changes have
+    built up the tables are written to path + ".snapshot" and the log is
+    emptied. Loading reads the snapshot and replays the log on top of it
     '''
-    def __init__(self):
+    def __init__(self, path=None, compact_every=10000, sync=False):
+        '''
+            :: path :: File to log changes to, None keeps the database in memory
+            :: compact_every :: Logged changes before the log is folded into a snapshot
+            :: sync :: fsync after every change, slower but survives power loss
+        '''
         self.tables = {}
+        self.path = path
+        self.compact_every = compact_every
+        self.sync = sync
+        self.log = None
+        self.logged = 0
+        self.lock = threading.RLock()
 
         # Setup your tables
         self.add_table('users', "id", "username", "password")
-        
+
+        if path is not None:
+            self.load()
+
         return
 
-    def add_table(self, table_name, *table_fields):
+    def add_table(self, table_name, *table_fields, compact=False):
         '''
             Adds a table to the database
+            Adding a table that already exists with the same fields keeps its contents
+
+            :: compact :: Store the table by column, see ColumnStore
         '''
-        table = Table(table_name, *table_fields)
-        self.tables[table_name] = table
+        with self.lock:
+            existing = self.tables.get(table_name)
+            if existing is not None and existing.fields == table_fields:
+                return
+
+            table = Table(table_name, *table_fields, compact=compact)
+            table.journal = self.append
+            self.tables[table_name] = table
+            self.append({"op": "table", "table": table_name, "fields": list(table_fields), "compact": compact})
 
         return
 
@@ -72,12 +362,135 @@ class DB():
         '''
         return self.tables[table_name].search_table(target_field_name, target_value)
 
+    def search_all(self, table_name, target_field_name, target_value):
+        '''
+            Calls the search all method on an appropriate table
+        '''
+        return self.tables[table_name].search_all(target_field_name, target_value)
+
+    def range_search(self, table_name, target_field_name, low=None, high=None):
+        '''
+            Calls the range search method on an appropriate table
+        '''
+        return self.tables[table_name].range_search(target_field_name, low, high)
+
     def create_table_entry(self, table_name, data):
         '''
             Calls the create entry method on the appropriate table
         '''
         return self.tables[table_name].create_entry(data)
 
+    def update_table_entries(self, table_name, target_field_name, target_value, changes):
+        '''
+            Calls the update entries method on the appropriate table
+        '''
+        return self.tables[table_name].update_entries(target_field_name, target_value, changes)
+
+    def delete_table_entries(self, table_name, target_field_name, target_value):
+        '''
+            Calls the delete entries method on the appropriate table
+        '''
+        return self.tables[table_name].delete_entries(target_field_name, target_value)
+
+    #-----------------------------------------------------------------------------
+    # Persistence
+    #-----------------------------------------------------------------------------
+
+    def snapshot_path(self):
+        return self.path + ".snapshot"
+
+    def append(self, entry):
+        '''
+            Writes one change to the log
+        '''
+        if self.log is None:
+            return
+
+        with self.lock:
+            self.log.write(json.dumps(entry) + "\n")
+            self.log.flush()
+            if self.sync:
+                os.fsync(self.log.fileno())
+            self.logged += 1
+
+            if self.logged >= self.compact_every:
+                self.compact()
+
+    def load(self):
+        '''
+            Rebuilds the tables from the snapshot and log, then starts logging
+        '''
+        with self.lock:
+            if os.path.exists(self.snapshot_path()):
+                with open(self.snapshot_path(), "r") as file:
+                    snapshot = json.load(file)
+                for table_name, saved in snapshot["tables"].items():
+                    self.restore_table(table_name, saved)
+
+            self.logged = 0
+            if os.path.exists(self.path):
+                with open(self.path, "r") as file:
+                    for line in file:
+                        try:
+                            entry = json.loads(line)
+                        except json.JSONDecodeError:
+                            # A write cut short by a crash, nothing after it was committed
+                            break
+                        self.replay(entry)
+                        self.logged += 1
+
+            self.log = open(self.path, "a")
+
+    def restore_table(self, table_name, saved):
+        table = Table(table_name, *saved["fields"], compact=saved.get("compact", False))
+        for row_id, row in saved["rows"]:
+            table.insert_row(row_id, row)
+        table.next_id = saved["next_id"]
+        table.journal = self.append
+        self.tables[table_name] = table
+
+    def replay(self, entry):
+        op = entry["op"]
+        if op == "table":
+            self.restore_table(entry["table"], dict(entry, next_id=0, rows=[]))
+            return
+
+        table = self.tables[entry["table"]]
+        if op == "insert":
+            table.insert_row(entry["id"], entry["data"])
+        elif op == "update":
+            table.replace_row(entry["id"], entry["data"])
+        elif op == "delete":
+            table.remove_row(entry["id"])
+
+    def compact(self):
+        '''
+            Writes every table to the snapshot and empties the log
+            The snapshot is swapped in whole, so a crash part way leaves the old one
+        '''
+        if self.path is None:
+            return
+
+        with self.lock:
+            snapshot = {"tables": dict((name, table.snapshot()) for name, table in self.tables.items())}
+            temp_path = self.snapshot_path() + ".tmp"
+            with open(temp_path, "w") as file:
+                json.dump(snapshot, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.snapshot_path())
+
+            if self.log is not None:
+                self.log.close()
+            self.log = open(self.path, "w")
+            self.logged = 0
+
+    def close(self):
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+
 
 # Our global database
 # Invoke this as needed
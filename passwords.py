@@ -0,0 +1,115 @@
+'''
+    Runs bcrypt hashing and checking on a small dedicated pool of threads
+
+    bcrypt is deliberately slow, tens to hundreds of milliseconds of CPU per
+    call. Running it inline means a burst of logins takes every core away from
+    chat and page traffic, so password work instead queues here behind a fixed
+    number of workers, and once the queue is full new requests fail straight
+    away with PoolBusy rather than piling up
+
+    bcrypt releases the GIL while it hashes, so threads are enough to use
+    several cores
+'''
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+
+class PoolBusy(Exception):
+    '''
+        Raised when the password pool's queue is full, the caller should try again later
+    '''
+    pass
+
+
+class PasswordPool():
+    '''
+        A bounded pool for bcrypt work with queue wait and hash time metrics
+    '''
+    def __init__(self, workers=2, max_queue=16, rounds=12):
+        '''
+            :: workers :: Threads hashing at once, at most one per core you can spare
+            :: max_queue :: Requests allowed to wait for a worker before new ones are refused
+            :: rounds :: bcrypt cost factor for new hashes, each step doubles the work
+        '''
+        self.workers = workers
+        self.max_queue = max_queue
+        self.rounds = rounds
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+        self.slots = threading.BoundedSemaphore(workers + max_queue)
+
+        self.lock = threading.Lock()
+        self.rejected = 0
+        self.in_flight = 0
+        self.stats = {}
+
+    def run(self, kind, function, *args):
+        '''
+            Runs a bcrypt call on the pool and waits for its result
+
+            :: kind :: Name the call is recorded under in the metrics
+        '''
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise PoolBusy("Password pool is full, try again shortly")
+
+        with self.lock:
+            self.in_flight += 1
+        queued_at = time.perf_counter()
+
+        def job():
+            started_at = time.perf_counter()
+            try:
+                return function(*args)
+            finally:
+                self.record(kind, started_at - queued_at, time.perf_counter() - started_at)
+
+        try:
+            return self.executor.submit(job).result()
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            self.slots.release()
+
+    def record(self, kind, wait, work):
+        with self.lock:
+            stats = self.stats.setdefault(kind, {"count": 0, "wait_seconds": 0.0, "hash_seconds": 0.0,
+                "max_wait_seconds": 0.0})
+            stats["count"] += 1
+            stats["wait_seconds"] += wait
+            stats["hash_seconds"] += work
+            stats["max_wait_seconds"] = max(stats["max_wait_seconds"], wait)
+
+    def hash(self, password):
+        '''
+            Hashes a password with a fresh salt at the configured cost
+
+            :: password :: The password as bytes
+        '''
+        return self.run("hash", bcrypt.hashpw, password, bcrypt.gensalt(self.rounds))
+
+    def check(self, password, hashed):
+        '''
+            Checks a password against a stored hash, the hash carries its own cost
+
+            :: password :: The password as bytes
+            :: hashed :: The stored hash
+        '''
+        return self.run("check", bcrypt.checkpw, password, hashed)
+
+    def metrics(self):
+        '''
+            Returns a snapshot of the pool's counters
+            Totals are in seconds, divide by count for averages
+        '''
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "in_flight": self.in_flight,
+                "rejected": self.rejected,
+                "calls": dict((kind, dict(stats)) for kind, stats in self.stats.items()),
+            }
@@ -15,7 +15,9 @@
 #-----------------------------------------------------------------------------
 import os
 import sys
-from bottle import run
+import logging
+import logging.handlers
+from bottle import run, default_app
 
 #-----------------------------------------------------------------------------
 # You may eventually wish to put these in their own directories and then load 
@@ -26,6 +28,7 @@ from bottle import run
 import model
 import view
 import controller
+import compression
 import gunicorn
 
 #-----------------------------------------------------------------------------
@@ -40,12 +43,83 @@ port = 8080
 # Turn this off for production
 debug = True
 
+# gunicorn worker processes for the 'server' command, and threads in each
+# The threaded worker keeps serving pages while chat streams long-poll, a
+# message is pushed straight to streams in the same process and reaches
+# the others on their next poll of the database
+workers = 1
+threads = 32
+
+# Chat streams each worker serves at once, the rest of its threads are kept for pages
+long_polls = threads // 2
+
+# Threads the async server gives to blocking work like sqlite and bcrypt
+async_workers = 32
+
+# Log lines are buffered and written in batches of this many, or straight
+# away once a warning or worse comes in, so requests don't wait on stdout
+# debug shows the per-request lines too
+log_buffer = 200
+
+def configure_logging():
+    '''
+        configure_logging
+        Sends the app's log lines to stderr through a buffer
+    '''
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    buffered = logging.handlers.MemoryHandler(log_buffer, flushLevel=logging.WARNING, target=stream)
+
+    root = logging.getLogger()
+    root.addHandler(buffered)
+    root.setLevel(logging.DEBUG if debug else logging.INFO)
+
+configure_logging()
+
+# Text responses at least this many bytes long are gzipped, or brotli'd if brotli is installed
+compress_minimum = 1024
+
+def wsgi_app():
+    '''
+        wsgi_app
+        Returns our routes wrapped in response compression
+    '''
+    return compression.Compressor(default_app(), minimum_size=compress_minimum)
+
 def run_server():    
     '''
         run_server
         Runs a bottle server
     '''
-    run(host=host, port=port, debug=debug, server='gunicorn', certfile='project.key.crt', keyfile='project.key')
+    # Never serve against an older schema than the code expects
+    migrate_db()
+
+    # Only watch templates for edits while debugging
+    model.page_view.reload_templates = debug
+    model.LONG_POLL_LIMIT = long_polls
+    run(app=wsgi_app(), host=host, port=port, debug=debug, server='gunicorn', certfile='project.key.crt', keyfile='project.key',
+        worker_class='gthread', workers=workers, threads=threads)
+
+def run_async_server():
+    '''
+        run_async_server
+        Runs the same routes on an asyncio event loop through uvicorn
+        Blocking database and bcrypt work happens in a thread pool, so idle
+        chat streams don't each hold a worker
+    '''
+    try:
+        import uvicorn
+    except ImportError:
+        print("The async server needs uvicorn, install it with 'pip install uvicorn'")
+        return
+
+    import asgi
+
+    migrate_db()
+    model.page_view.reload_templates = debug
+    uvicorn.run(asgi.application(max_workers=async_workers, wsgi_app=wsgi_app()), host=host, port=port,
+        log_level='debug' if debug else 'info',
+        ssl_certfile='project.key.crt', ssl_keyfile='project.key')
 
 #-----------------------------------------------------------------------------
 # Optional SQL support
@@ -58,6 +132,32 @@ def manage_db():
     '''
     pass
 
+def migrate_db():
+    '''
+        migrate_db
+        Upgrades project.db to the latest schema version, keeping its data
+    '''
+    applied = model.db.migrate()
+    for version, description in applied:
+        print("Applied migration {version}: {description}".format(version=version, description=description))
+    if len(applied) == 0:
+        print("Database schema is up to date")
+
+    # Close rather than pool the connection, gunicorn forks after this and
+    # SQLite connections mustn't be carried into a child process
+    model.end_request()
+    model.db.pool.close()
+
+def rebuild_search():
+    '''
+        rebuild_search
+        Rebuilds the message search index from the stored messages
+    '''
+    migrate_db()
+    model.rebuild_message_search()
+    model.end_request()
+    print("Rebuilt the message search index")
+
 """
 import sql
     
@@ -79,7 +179,10 @@ def manage_db():
 
 command_list = {
     'manage_db' : manage_db,
-    'server'       : run_server
+    'migrate'      : migrate_db,
+    'rebuild_search' : rebuild_search,
+    'server'       : run_server,
+    'async_server' : run_async_server
 }
 
 # The default command if none other is given
@@ -0,0 +1,167 @@
+'''
+    Signed login sessions
+
+    Logging in stores a random session id in the Sessions table and hands the
+    browser a cookie holding that id plus an HMAC of it, so a cookie can only
+    come from us and is checked without touching the database. Sessions in
+    use are kept in an LRU in memory, and each one lazily caches data about
+    its user, like the friend list and todos, until a change invalidates it
+
+    The Sessions table is shared by every server process, the in-memory copy
+    is only trusted for a short ttl so logouts and removals made by other
+    processes catch up
+'''
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+import weakref
+
+import cache
+
+
+class Session():
+    '''
+        A signed in user, with a cache of data loaded on their behalf
+    '''
+    def __init__(self, session_id, username, expires, cache_ttl=60):
+        self.id = session_id
+        self.username = username
+        self.expires = expires
+
+        # Loaded data, e.g. "friends" -> rows, see get()
+        self.cache = cache.FragmentCache(ttl=cache_ttl)
+
+        # The user's data version the cache was last checked against
+        self.version = None
+
+    def get(self, key, load):
+        '''
+            Returns the cached value for key, calling load() to fetch it if needed
+        '''
+        return self.cache.get(key, load)
+
+    def invalidate(self, *keys):
+        for key in keys:
+            self.cache.invalidate(key)
+
+
+class SessionStore():
+    '''
+        Creates, checks and ends sessions, backed by the database
+    '''
+    def __init__(self, db, secret=None, lifetime=7 * 24 * 3600, capacity=10000, cache_ttl=60):
+        '''
+            :: db :: The SQLDatabase holding the Sessions table
+            :: secret :: Key the cookies are signed with, defaults to the one stored in the database
+            :: lifetime :: Seconds a session lasts after logging in
+            :: capacity :: Sessions kept in memory
+            :: cache_ttl :: Seconds a session and its cached data are trusted before being reloaded
+        '''
+        self.db = db
+        self.secret = secret
+        self.lifetime = lifetime
+        self.cache_ttl = cache_ttl
+        self.sessions = cache.LRUCache(capacity, ttl=cache_ttl)
+
+        # username -> the sessions in memory for that user, evicted ones drop out by themselves
+        self.by_user = {}
+        self.lock = threading.Lock()
+
+    def key(self):
+        # Read lazily, the Settings table may not exist until the server has migrated
+        if self.secret is None:
+            secret = self.db.get_setting("session_secret")
+            if secret is None:
+                raise RuntimeError("No session secret, run 'python run.py migrate'")
+            self.secret = bytes(secret)
+        return self.secret
+
+    def mac(self, session_id):
+        return hmac.new(self.key(), session_id.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def sign(self, session_id):
+        return session_id + "." + self.mac(session_id)
+
+    def unsign(self, token):
+        '''
+            Returns the session id a cookie carries, or None if it wasn't signed by us
+        '''
+        if not token or "." not in token:
+            return None
+        session_id, mac = token.rsplit(".", 1)
+        if not hmac.compare_digest(self.mac(session_id), mac):
+            return None
+        return session_id
+
+    def remember(self, session):
+        self.sessions.put(session.id, session)
+        with self.lock:
+            self.by_user.setdefault(session.username, weakref.WeakSet()).add(session)
+
+    def create(self, username):
+        '''
+            Starts a session for a user who has just logged in
+
+            Returns the signed token to set as their cookie
+        '''
+        now = time.time()
+        session = Session(secrets.token_urlsafe(32), username, now + self.lifetime, self.cache_ttl)
+        self.db.add_session(session.id, username, session.expires, now)
+        self.remember(session)
+        return self.sign(session.id)
+
+    def get(self, token):
+        '''
+            Returns the Session a cookie belongs to, or None if it is forged, expired or ended
+        '''
+        session_id = self.unsign(token)
+        if session_id is None:
+            return None
+
+        now = time.time()
+        session = self.sessions.get(session_id)
+        if session is None:
+            row = self.db.get_session(session_id, now)
+            if row is None:
+                return None
+            session = Session(session_id, row[0], row[1], self.cache_ttl)
+            self.remember(session)
+
+        if session.expires <= now:
+            self.sessions.pop(session_id)
+            return None
+        return session
+
+    def end(self, token):
+        '''
+            Logs a session out
+        '''
+        session_id = self.unsign(token)
+        if session_id is None:
+            return
+        self.sessions.pop(session_id)
+        self.db.remove_session(session_id)
+
+    def user_sessions(self, username):
+        with self.lock:
+            if username is None:
+                return [session for sessions in self.by_user.values() for session in sessions]
+            return list(self.by_user.get(username, ()))
+
+    def invalidate(self, username, *keys):
+        '''
+            Drops cached data from every session of a user, or of every user if username is None
+        '''
+        for session in self.user_sessions(username):
+            session.invalidate(*keys)
+
+    def forget_user(self, username):
+        '''
+            Drops a removed user's sessions from memory, their rows are deleted with the user
+        '''
+        for session in self.user_sessions(username):
+            self.sessions.pop(session.id)
+        with self.lock:
+            self.by_user.pop(username, None)
@@ -1,7 +1,17 @@
 import sqlite3
 import bcrypt
+import itertools
+import logging
+import queue
+import threading
+import time
+import migrations
+import cache
+from concurrent.futures import Future
 from diffiehellman import DiffieHellman
 
+logger = logging.getLogger(__name__)
+
 
 # This class is a simple handler for all of our SQL database actions
 # Practicing a good separation of concerns, we should only ever call 
@@ -9,6 +19,429 @@ from diffiehellman import DiffieHellman
 
 # If you notice anything out of place here, consider it to your advantage and don't spoil the surprise
 
+# Gives each shared in-memory database its own name
+_memory_ids = itertools.count()
+
+# PRAGMA settings applied to every new connection, pick one per deployment
+# "durable" fsyncs on every commit so nothing is lost on a power cut
+# "fast" only fsyncs at WAL checkpoints, a crash can lose the last few commits
+# Negative cache_size values are in KiB, busy_timeout is in milliseconds
+PRAGMA_PROFILES = {
+    "durable": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "cache_size": -16000,
+        "mmap_size": 0,
+        "temp_store": "DEFAULT",
+        "busy_timeout": 5000,
+    },
+    "fast": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64000,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+}
+
+
+def pragma_profile(profile="durable", **overrides):
+    '''
+        Looks up a PRAGMA profile by name and applies any overrides to it
+
+        :: profile :: One of the PRAGMA_PROFILES names
+        :: overrides :: Individual PRAGMA values to change
+    '''
+    if profile not in PRAGMA_PROFILES:
+        raise ValueError("Unknown PRAGMA profile '{profile}'".format(profile=profile))
+
+    pragmas = dict(PRAGMA_PROFILES[profile])
+    pragmas.update(overrides)
+    return pragmas
+
+#-----------------------------------------------------------------------------
+# Statements
+# Every query the app runs, by name. Each one has a single fixed text that is
+# bound with parameters, so a connection compiles it the first time it runs
+# and takes the compiled statement from its cache every time after that
+# Add new queries here rather than building SQL strings in methods
+#-----------------------------------------------------------------------------
+
+STATEMENTS = {
+    # Users
+    "add_user": "INSERT INTO Users VALUES(?, ?, ?)",
+    "get_password": "SELECT password FROM Users WHERE username = ?",
+    "user_exists": "SELECT 1 FROM Users WHERE username = ?",
+    "remove_user": "DELETE FROM Users WHERE username = :username",
+    "remove_user_friends": "DELETE FROM Friends WHERE user1 = :username OR user2 = :username",
+    "remove_user_messages": """DELETE FROM Messages WHERE chat_id IN (
+        SELECT id FROM Chats WHERE user1 = :username UNION ALL SELECT id FROM Chats WHERE user2 = :username)""",
+    "remove_user_chats": "DELETE FROM Chats WHERE user1 = :username OR user2 = :username",
+    "remove_user_todos": "DELETE FROM Todos WHERE username = :username",
+    "remove_user_sessions": "DELETE FROM Sessions WHERE username = :username",
+
+    # Sessions and settings
+    "remove_expired_sessions": "DELETE FROM Sessions WHERE expires <= ?",
+    "add_session": "INSERT INTO Sessions(id, username, expires) VALUES(?, ?, ?)",
+    "get_session": "SELECT username, expires FROM Sessions WHERE id = ? AND expires > ?",
+    "remove_session": "DELETE FROM Sessions WHERE id = ?",
+    "get_setting": "SELECT value FROM Settings WHERE name = ?",
+
+    # Data versions, bumped by triggers, see migrations.versions()
+    "get_friend_list_versions": """SELECT
+        (SELECT version FROM Versions WHERE name = 'user:' || ?),
+        (SELECT version FROM Versions WHERE name = 'guides')""",
+
+    # Chats, updating a conflicting row to itself still returns its id
+    "create_chat": """INSERT INTO Chats(user1, user2) VALUES(?, ?)
+        ON CONFLICT(user1, user2) DO UPDATE SET size = size
+        RETURNING id""",
+    "get_chat_id": "SELECT id FROM Chats WHERE user1 = ? AND user2 = ?",
+    "get_chat_version": "SELECT id, size FROM Chats WHERE user1 = ? AND user2 = ?",
+    "claim_message_index": "UPDATE Chats SET size = size + 1 WHERE id = ? RETURNING size",
+    "insert_message": "INSERT INTO Messages(chat_id, sender, receiver, message, message_index) VALUES(?, ?, ?, ?, ?)",
+    "chat_page_newest": """SELECT sender, message, message_index FROM Messages
+        WHERE chat_id = ? ORDER BY message_index DESC LIMIT ?""",
+    "chat_page_before": """SELECT sender, message, message_index FROM Messages
+        WHERE chat_id = ? AND message_index < ? ORDER BY message_index DESC LIMIT ?""",
+    "chat_page_after": """SELECT sender, message, message_index FROM Messages
+        WHERE chat_id = ? AND message_index > ? ORDER BY message_index ASC LIMIT ?""",
+
+    # Message search, the MATCH expression carries both the words and the chats to look in
+    "get_user_chats": "SELECT id FROM Chats WHERE user1 = ? UNION ALL SELECT id FROM Chats WHERE user2 = ?",
+    "search_messages": """SELECT Messages.chat_id, Messages.sender, Messages.receiver, Messages.message_index,
+            snippet(MessagesFTS, 0, char(2), char(3), '...', 16)
+        FROM MessagesFTS JOIN Messages ON Messages.id = MessagesFTS.rowid
+        WHERE MessagesFTS MATCH ? ORDER BY rank LIMIT ? OFFSET ?""",
+    "rebuild_message_search": "INSERT INTO MessagesFTS(MessagesFTS) VALUES('rebuild')",
+    "optimize_message_search": "INSERT INTO MessagesFTS(MessagesFTS) VALUES('optimize')",
+
+    # Guides
+    "get_guides": "SELECT course_code, course_name, course_description FROM Guides",
+    "get_guide": "SELECT course_code, course_name, course_description FROM Guides WHERE course_code = ?",
+    "add_guide": "INSERT INTO Guides(course_code, course_name, course_description) VALUES(?, ?, ?)",
+    # Takes the write lock up front, so what a transaction reads can't change before it writes
+    "begin_write": "BEGIN IMMEDIATE",
+    "remove_guide": "DELETE FROM Guides WHERE course_code = ?",
+    "latest_guides": """SELECT course_code, course_name, course_description FROM Guides
+        ORDER BY id DESC LIMIT ?""",
+    "guides_page": """SELECT course_code, course_name, course_description FROM Guides
+        ORDER BY course_code LIMIT ? OFFSET ?""",
+    "search_guides": """SELECT Guides.course_code, Guides.course_name, Guides.course_description
+        FROM GuidesFTS JOIN Guides ON Guides.id = GuidesFTS.rowid
+        WHERE GuidesFTS MATCH ? ORDER BY rank LIMIT ? OFFSET ?""",
+    "guide_codes_from": """SELECT course_code, course_name FROM Guides
+        WHERE course_code >= ? AND course_code < ? ORDER BY course_code LIMIT ?""",
+
+    # Friends
+    "get_friends": "SELECT user2 FROM Friends WHERE user1 = ?",
+    "add_friend": "INSERT INTO Friends VALUES(?, ?)",
+    "remove_friend": "DELETE FROM Friends WHERE user1 = ? AND user2 = ?",
+
+    # Todos
+    "add_todo": "INSERT INTO Todos(username, todo) VALUES(?, ?)",
+    "get_todos": "SELECT todo FROM Todos WHERE username = ?",
+    "remove_todo": "DELETE FROM Todos WHERE username = ? AND todo = ?",
+}
+
+# Compiled statements each connection keeps, room for every named statement
+# plus the bulk lookups in existing_keys
+CACHED_STATEMENTS = 256
+
+# The guides a fresh database starts with
+COURSE_GUIDES = [
+    ('INFO1110', 'Intro to Programming', 'This course is an introduction to computer science. It covers the basics of programming in Python.'),
+    ('INFO1113', 'Object-Oriented Programming', 'This course is an introduction to computer science. It covers the basics of programming in Java.'),
+    ('COMP2123', 'Data Structures and Algorithms', 'This course is an introduction to data structures and algorithms. It covers the basics of data structures and algorithms.'),
+    ('COMP2017', 'Systems Programming', 'This course is an introduction to operating systems and machine principles. It covers the basics of operating systems and machine principles.'),
+]
+
+
+class PoolTimeout(Exception):
+    '''
+        Raised when no connection could be checked out of the pool in time
+    '''
+    pass
+
+
+class ConnectionPool():
+    '''
+        A bounded pool of SQLite connections
+
+        SQLite connections and cursors can't be shared between threads, so each
+        thread checks out its own connection on first use and keeps it until
+        release() hands it back to the pool
+    '''
+
+    def __init__(self, database_arg, size=5, timeout=10.0, health_check_interval=30.0, pragmas=None):
+        '''
+            :: database_arg :: Path to the database file, or ":memory:"
+            :: pragmas :: PRAGMA name to value mapping run on every new connection
+            :: size :: Maximum number of connections open at once
+            :: timeout :: Seconds to wait for a free connection before giving up
+            :: health_check_interval :: Idle connections older than this are pinged before reuse
+        '''
+        self.uri = database_arg == ":memory:"
+
+        # Every plain ":memory:" connection is its own empty database,
+        # so the pool shares one named in-memory database instead
+        if self.uri:
+            database_arg = "file:memdb{id}?mode=memory&cache=shared".format(id=next(_memory_ids))
+
+        self.database_arg = database_arg
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.pragmas = pragmas or {}
+
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.local = threading.local()
+
+        # A shared in-memory database only lives while a connection to it is open
+        self.anchor = self.connect() if self.uri else None
+
+    def connect(self):
+        '''
+            Opens a new connection, it is handed between threads so the
+            same-thread check is turned off
+        '''
+        conn = sqlite3.connect(self.database_arg, uri=self.uri, check_same_thread=False,
+            cached_statements=CACHED_STATEMENTS)
+
+        # journal_mode is persistent in the file, the rest only last as long as the connection
+        for name, value in self.pragmas.items():
+            conn.execute("PRAGMA {name} = {value}".format(name=name, value=value))
+
+        return conn
+
+    def healthy(self, conn):
+        '''
+            Pings a connection, returns False if it can no longer be used
+        '''
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        '''
+            Returns the (connection, cursor) pair held by the calling thread,
+            checking one out of the pool if it doesn't hold one yet
+        '''
+        held = getattr(self.local, "held", None)
+        if held is not None:
+            return held
+
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolTimeout("No database connection free after {timeout}s".format(timeout=self.timeout))
+
+        try:
+            conn = None
+            while conn is None:
+                try:
+                    conn, released_at = self.idle.get_nowait()
+                except queue.Empty:
+                    conn = self.connect()
+                    break
+
+                # Only ping connections that have been sitting around for a while
+                stale = time.monotonic() - released_at > self.health_check_interval
+                if stale and not self.healthy(conn):
+                    conn.close()
+                    conn = None
+        except BaseException:
+            self.slots.release()
+            raise
+
+        self.local.held = (conn, conn.cursor())
+        return self.local.held
+
+    def release(self):
+        '''
+            Hands the calling thread's connection back to the pool
+            Anything left uncommitted is rolled back
+        '''
+        held = getattr(self.local, "held", None)
+        if held is None:
+            return
+
+        conn, cur = held
+        self.local.held = None
+        cur.close()
+
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self.idle.put((conn, time.monotonic()))
+        except sqlite3.Error:
+            conn.close()
+        finally:
+            self.slots.release()
+
+    def close(self):
+        '''
+            Closes every idle connection
+        '''
+        self.release()
+        while True:
+            try:
+                conn, _ = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+        if self.anchor is not None:
+            self.anchor.close()
+            self.anchor = None
+
+
+def conversation_key(user1, user2):
+    '''
+        Returns the canonical (user1, user2) order a conversation is stored under
+    '''
+    return (user1, user2) if user1 <= user2 else (user2, user1)
+
+
+def match_terms(text, prefix_last=False):
+    '''
+        Returns text as FTS5 terms that must all match, or None if it has no words
+
+        Words are quoted, so nothing typed is read as FTS5 syntax, a word
+        ending in * matches as a prefix, and so does the last one with prefix_last
+    '''
+    words = text.split()
+    terms = []
+    for i, word in enumerate(words):
+        prefix = word.endswith("*") or (prefix_last and i == len(words) - 1)
+        word = word.rstrip("*")
+        if word != "":
+            terms.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+    return " ".join(terms) if len(terms) > 0 else None
+
+
+def match_expression(text, chat_ids):
+    '''
+        Returns the FTS5 MATCH expression for messages in one of chat_ids
+        holding every word of text, or None if there is nothing to search
+    '''
+    terms = match_terms(text)
+    if terms is None or len(chat_ids) == 0:
+        return None
+    chats = " OR ".join('"{chat_id}"'.format(chat_id=chat_id) for chat_id in chat_ids)
+    return "message : ({terms}) AND chat_id : ({chats})".format(terms=terms, chats=chats)
+
+
+def prefix_range(prefix):
+    '''
+        Returns (low, high) such that low <= value < high holds for exactly the strings starting with prefix,
+        so a prefix search is one range seek on an index
+    '''
+    return prefix, prefix + chr(0x10FFFF)
+
+
+# Statements insert_message() runs for each message
+MESSAGE_STATEMENTS = 2
+
+def insert_message(query, chat_id, sender, receiver, message):
+    '''
+        Stores a message inside the caller's transaction
+        The UPDATE claims the next message_index in the same statement that bumps the size
+
+        :: query :: Runs a named statement, SQLDatabase.query or a GroupCommitter writer's
+
+        Returns the message_index, or None if the chat no longer exists
+    '''
+    res = query("claim_message_index", [chat_id]).fetchone()
+    if res is None:
+        return None
+
+    message_index = res[0]
+    query("insert_message", [chat_id, sender, receiver, message, message_index])
+    return message_index
+
+
+class GroupCommitter():
+    '''
+        Funnels message inserts from every thread through one writer
+
+        While the writer waits on a commit's fsync, new messages queue up, and
+        the next commit takes all of them at once. A burst of senders shares
+        a handful of fsyncs instead of paying one each, and nobody waits
+        longer than one commit cycle
+    '''
+    def __init__(self, pool, max_batch=64, max_wait=0.0, timeout=10.0):
+        '''
+            :: pool :: The ConnectionPool whose settings the writer's connection uses
+            :: max_batch :: Most inserts to put in one transaction
+            :: max_wait :: Seconds to hold a transaction open for more inserts, 0 takes only what is already queued
+            :: timeout :: Seconds a sender waits for its commit before giving up
+        '''
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+        self.commits = 0
+        self.messages = 0
+
+    def submit(self, chat_id, sender, receiver, message):
+        '''
+            Queues a message and waits until it is committed
+            Returns the same as insert_message()
+        '''
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="group-commit", daemon=True)
+                self.thread.start()
+
+        future = Future()
+        self.pending.put(((chat_id, sender, receiver, message), future))
+        return future.result(timeout=self.timeout)
+
+    def next_batch(self):
+        batch = [self.pending.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                remaining = deadline - time.monotonic()
+                batch.append(self.pending.get(timeout=remaining) if remaining > 0 else self.pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    # Runs a named statement on the writer's cursor
+    def query(self, cur, name, params=()):
+        return cur.execute(STATEMENTS[name], params)
+
+    def run(self):
+        # The writer keeps its own connection for good, outside the pool's limit
+        conn = self.pool.connect()
+        while True:
+            batch = self.next_batch()
+            cur = conn.cursor()
+            query = lambda name, params=(): self.query(cur, name, params)
+            try:
+                results = [insert_message(query, *args) for args, _ in batch]
+                conn.commit()
+            except Exception as error:
+                conn.rollback()
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            finally:
+                cur.close()
+
+            self.commits += 1
+            self.messages += len(batch)
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
 class SQLDatabase():
     '''
         Our SQL Database
@@ -16,21 +449,66 @@ class SQLDatabase():
     '''
 
     # Get the database running
-    def __init__(self, database_arg=":memory:"):
-        self.conn = sqlite3.connect(database_arg)
-        self.cur = self.conn.cursor()
+    # profile names one of the PRAGMA_PROFILES, pragmas overrides single settings from it
+    def __init__(self, database_arg=":memory:", pool_size=5, pool_timeout=10.0, health_check_interval=30.0,
+            profile="durable", pragmas=None, group_commit=False, friend_cache_size=10000, friend_cache_ttl=60):
+        self.pool = ConnectionPool(database_arg, size=pool_size, timeout=pool_timeout,
+            health_check_interval=health_check_interval, pragmas=pragma_profile(profile, **(pragmas or {})))
+
+        # With group_commit on, concurrent add_message calls share transactions
+        self.group_committer = GroupCommitter(self.pool) if group_commit else None
+
+        # Canonical (user1, user2) -> Chats.id, chat ids never change so
+        # entries only go when a chat is deleted
+        self.conversations = {}
+        self.conversations_max = 10000
+        self.conversations_lock = threading.Lock()
+
+        # username -> frozenset of the users they've added, the friend writes
+        # below update it as they commit so reads never go to disk twice
+        # The ttl bounds how long changes made by other server processes take to show up
+        # friend_versions stops a read that raced with a write caching what it read
+        self.friend_graph = cache.LRUCache(friend_cache_size, ttl=friend_cache_ttl)
+        self.friend_versions = {}
+        self.friends_lock = threading.Lock()
 
-    # SQLite 3 does not natively support multiple commands in a single statement
-    # Using this handler restores this functionality
-    # This only returns the output of the last command
+        # Callbacks to run once a change has been committed, keyed by event name
+        self.listeners = {}
+
+    # Each thread gets its own connection and cursor from the pool
+    @property
+    def conn(self):
+        return self.pool.acquire()[0]
+
+    @property
+    def cur(self):
+        return self.pool.acquire()[1]
+
+    # Hand this thread's connection back to the pool, call this at the end of each request
+    def release(self):
+        self.pool.release()
+
+    # Register a callback for an event, see notify() calls for the arguments each one gets
+    def on(self, event, callback):
+        self.listeners.setdefault(event, []).append(callback)
+
+    def notify(self, event, *args):
+        for callback in self.listeners.get(event, []):
+            callback(*args)
+
+    # Runs one of the named STATEMENTS with its parameters and returns the cursor
+    # Errors are raised, it's up to the caller to roll back
+    def query(self, name, params=()):
+        return self.cur.execute(STATEMENTS[name], params)
+
+    # Runs a named statement once for each set of parameters
+    def query_many(self, name, params):
+        return self.cur.executemany(STATEMENTS[name], params)
+
+    # Runs a script of several ';' separated statements, for setup and maintenance
+    # The script commits anything pending first, errors are raised
     def execute(self, sql_string):
-        out = None
-        for string in sql_string.split(";"):
-            try:
-                out = self.cur.execute(string)
-            except:
-                pass
-        return out
+        self.cur.executescript(sql_string)
 
     # Commit changes to the database
     def commit(self):
@@ -38,73 +516,40 @@ class SQLDatabase():
 
     #-----------------------------------------------------------------------------
     
+    # Brings the schema up to date without touching existing data
+    # Returns a list of (version, description) for the migrations applied
+    def migrate(self, target=None):
+        return migrations.migrate(self.conn, target)
+
     # Sets up the database
     # Default admin password
     def database_setup(self, admin_password='admin'):
 
         # Clear the database if needed
-        self.execute("DROP TABLE IF EXISTS Users")
-        self.execute("DROP TABLE IF EXISTS Chats")
-        self.execute("DROP TABLE IF EXISTS Messages")
-        self.execute("DROP TABLE IF EXISTS Guides")
-        self.execute("DROP TABLE IF EXISTS Friends")
-        self.execute("DROP TABLE IF EXISTS Todos")
-        self.commit()
+        self.execute("""
+            DROP TABLE IF EXISTS Users;
+            DROP TABLE IF EXISTS Chats;
+            DROP TABLE IF EXISTS Messages;
+            DROP TABLE IF EXISTS Guides;
+            DROP TABLE IF EXISTS Friends;
+            DROP TABLE IF EXISTS Todos;
+            DROP TABLE IF EXISTS Sessions;
+            DROP TABLE IF EXISTS Settings;
+            DROP TABLE IF EXISTS Versions;
+            DROP TABLE IF EXISTS MessagesFTS;
+            DROP TABLE IF EXISTS GuidesFTS;
+            PRAGMA user_version = 0;
+        """)
 
-        # Create the users table
-        self.execute("""CREATE TABLE Users(
-            username TEXT,
-            password TEXT,
-            admin INTEGER DEFAULT 0
-        )""")
-
-        # Create the chats table
-        self.execute("""CREATE TABLE Chats(
-            user1 TEXT,
-            user2 TEXT,
-            size INTEGER DEFAULT 0,
-            PRIMARY KEY(user1, user2)
-        )""")
-
-        # Create the messages table
-        self.execute("""CREATE TABLE Messages(
-            sender TEXT,
-            receiver TEXT,
-            message TEXT,
-            message_index INTEGER,
-            FOREIGN KEY(sender, receiver) REFERENCES Chats(user1, user2),
-            PRIMARY KEY(sender, receiver, message, message_index)
-        )""")
-
-        # Create course guides table
-        self.execute("""CREATE TABLE Guides(
-            course_code TEXT,
-            course_name TEXT,
-            course_description TEXT,
-            PRIMARY KEY(course_code)
-        )""")
-
-        # Create a friendship table
-        self.execute("""CREATE TABLE Friends(
-            user1 TEXT,
-            user2 TEXT,
-            PRIMARY KEY(user1, user2)
-        )""")
-
-        # Create a todo list table
-        self.execute("""CREATE TABLE Todos(
-            username TEXT,
-            todo TEXT,
-            PRIMARY KEY(username, todo)
-        )""")
-    
-        self.commit()
+        # Build the schema from scratch
+        self.migrate()
 
         # Add our admin user
         self.add_user('admin', admin_password, admin=1)
 
         # init course guides
-        print(self.init_course_guides())
+        self.init_course_guides()
+        logger.info("Database reset with %d course guides", len(COURSE_GUIDES))
 
     #-----------------------------------------------------------------------------
     # User handling
@@ -114,302 +559,472 @@ class SQLDatabase():
     def add_user(self, username, password, admin=0):
         
         data = [username, password, admin]
-        self.cur.execute("INSERT INTO Users VALUES(?, ?, ?)", data)
+        self.query("add_user", data)
         self.commit()
 
         return True
     
+    # Statements run for each removed user, each takes the username as :username
+    REMOVE_USER_STATEMENTS = [
+        "remove_user",
+        "remove_user_friends",
+        "remove_user_messages",
+        "remove_user_chats",
+        "remove_user_todos",
+        "remove_user_sessions",
+    ]
+
+    # Muting removes all of a user's friendships
+    MUTE_USER_STATEMENTS = [
+        "remove_user_friends",
+    ]
+
     def remove_user(self, username):
-        self.cur.execute("DELETE FROM Users WHERE username = ?", [username])
-        self.cur.execute("DELETE FROM Friends WHERE user1 = ? OR user2 = ?", [username, username])
-        self.cur.execute("DELETE FROM Chats WHERE user1 = ? OR user2 = ?", [username, username])
-        self.cur.execute("DELETE FROM Todos WHERE username = ?", [username])
-        self.commit()
+        try:
+            for name in self.REMOVE_USER_STATEMENTS:
+                self.query(name, {"username": username})
+            self.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        self.forget_conversations(username)
+        self.forget_friends(username)
+        self.notify("user_removed", username)
         
         return True
     
     def mute_user(self, username):
         # Remove all friends from user
-        print("MUTING USER: ", username)
-        self.cur.execute("DELETE FROM Friends WHERE user1 = ? OR user2 = ?", [username, username])
-        self.commit()
+        logger.info("Muting user %s", username)
+        try:
+            for name in self.MUTE_USER_STATEMENTS:
+                self.query(name, {"username": username})
+            self.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        self.forget_friends(username)
+        self.notify("user_muted", username)
+
+    #-----------------------------------------------------------------------------
+    # Bulk operations
+    # Each one runs as a single transaction with executemany and returns a
+    # (key, outcome) pair for every input row, in input order
+    #-----------------------------------------------------------------------------
+
+    # Returns which of keys already exist in table.column
+    # table and column are always our own names, never user input
+    # Short chunks are padded with NULLs, which never match, so there is one
+    # statement text per column and it stays in the statement cache
+    def existing_keys(self, table, column, keys, chunk_size=500):
+        keys = list(set(keys))
+        found = set()
+        sql_query = "SELECT {column} FROM {table} WHERE {column} IN ({marks})".format(
+            column=column, table=table, marks=", ".join("?" * chunk_size))
+        for start in range(0, len(keys), chunk_size):
+            chunk = keys[start:start + chunk_size]
+            chunk += [None] * (chunk_size - len(chunk))
+            found.update(row[0] for row in self.cur.execute(sql_query, chunk))
+        return found
+
+    # rows are (course_code, course_name, course_description)
+    # Outcomes are "added", "exists", "duplicate" (repeated in this upload) or "invalid"
+    # The check and the insert share one write transaction, so a guide added
+    # by someone else in between can't make the insert fail
+    def add_course_guides(self, rows):
+        seen = set()
+        outcomes = []
+        to_insert = []
+
+        try:
+            self.query("begin_write")
+            existing = self.existing_keys("Guides", "course_code", [row[0] for row in rows if row[0]])
+
+            for row in rows:
+                course_code = row[0]
+                if not course_code:
+                    outcomes.append((course_code, "invalid"))
+                elif course_code in existing:
+                    outcomes.append((course_code, "exists"))
+                elif course_code in seen:
+                    outcomes.append((course_code, "duplicate"))
+                else:
+                    seen.add(course_code)
+                    to_insert.append(row)
+                    outcomes.append((course_code, "added"))
+
+            self.query_many("add_guide", to_insert)
+            self.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        self.notify("guides")
+
+        return outcomes
+
+    # Outcomes are "removed" or "not_found"
+    def remove_course_guides(self, course_codes):
+        existing = self.existing_keys("Guides", "course_code", course_codes)
+        try:
+            self.query_many("remove_guide", [[code] for code in existing])
+            self.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        self.notify("guides")
+
+        return [(code, "removed" if code in existing else "not_found") for code in course_codes]
+
+    # Runs a list of named per-user statements for every username that exists
+    # Outcomes are done_outcome or "not_found"
+    def moderate_users(self, usernames, statements, done_outcome):
+        existing = self.existing_keys("Users", "username", usernames)
+        params = [{"username": username} for username in existing]
+        try:
+            for name in statements:
+                self.query_many(name, params)
+            self.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+
+        return [(username, done_outcome if username in existing else "not_found") for username in usernames]
+
+    def remove_users(self, usernames):
+        outcomes = self.moderate_users(usernames, self.REMOVE_USER_STATEMENTS, "removed")
+        for username, outcome in outcomes:
+            if outcome == "removed":
+                self.forget_conversations(username)
+                self.forget_friends(username)
+                self.notify("user_removed", username)
+        return outcomes
+
+    def mute_users(self, usernames):
+        outcomes = self.moderate_users(usernames, self.MUTE_USER_STATEMENTS, "muted")
+        for username, outcome in outcomes:
+            if outcome == "muted":
+                self.forget_friends(username)
+                self.notify("user_muted", username)
+        return outcomes
 
     #-----------------------------------------------------------------------------
 
     # Check login credentials
-    def check_credentials(self, username, password):
-        sql_query = """
-                SELECT password
-                FROM Users
-                WHERE username = '{username}'
-            """
-
-        sql_query = sql_query.format(username=username)
-        self.execute(sql_query)
-        res = self.cur.fetchone()
+    # checkpw can be swapped for something that runs bcrypt off the request thread
+    def check_credentials(self, username, password, checkpw=bcrypt.checkpw):
+        res = self.query("get_password", [username]).fetchone()
         if res is None:
             return False
 
         true_pw = res[0]
 
-        if bcrypt.checkpw(password, true_pw):
+        # bcrypt takes a while, hand the connection back so other requests can use it meanwhile
+        self.release()
+        if checkpw(password, true_pw):
             return True
         
     def check_username(self, username):
-        sql_query = """
-                SELECT username 
-                FROM Users
-                WHERE username = '{username}'
-            """
-        sql_query = sql_query.format(username=username)
-        self.execute(sql_query)
-        
-        res = self.cur.fetchone()
+        res = self.query("user_exists", [username]).fetchone()
 
         if res is not None:
             return True
         else:
             return False
         
-    # def get_friends(self, username):
-    #     sql_query = """
-    #             SELECT username 
-    #             FROM Users
-    #             WHERE NOT username = '{username}'
-    #         """
-    #     sql_query = sql_query.format(username=username)
-    #     self.execute(sql_query)
-        
-    #     res = self.cur.fetchall()
-        
-    #     if res is not None:
-    #         return res
-    #     else:
-    #         return False
-    
-    def chat_exists(self, user1, user2):
-        self.cur.execute("SELECT * FROM Chats WHERE user1 = ? AND user2 = ?", [user1, user2])
-        res1 = self.cur.fetchone()
+    #-----------------------------------------------------------------------------
+    # Sessions
+    #-----------------------------------------------------------------------------
 
-        print("CHECKING CHAT EXISTENCE\nRES1: ", res1)
-        if res1 is None:
-            return False
+    # Stores a new session, clearing out any that have expired while we're here
+    def add_session(self, session_id, username, expires, now):
+        self.query("remove_expired_sessions", [now])
+        self.query("add_session", [session_id, username, expires])
+        self.commit()
+
+    # Returns (username, expires) for a session that hasn't expired, or None
+    def get_session(self, session_id, now):
+        return self.query("get_session", [session_id, now]).fetchone()
+
+    def remove_session(self, session_id):
+        self.query("remove_session", [session_id])
+        self.commit()
+
+    # Returns a value from Settings, or None
+    def get_setting(self, name):
+        res = self.query("get_setting", [name]).fetchone()
+        return res[0] if res is not None else None
+
+    # Returns (version of username's friends and todos, version of the guides)
+    def get_friend_list_versions(self, username):
+        user_version, guides_version = self.query("get_friend_list_versions", [username]).fetchone()
+        return user_version or 0, guides_version or 0
+
+    # Returns (chat id, messages in it) for a conversation, or None if there isn't one
+    # Messages are only ever added, so the pair changes whenever the chat does
+    def get_chat_version(self, user1, user2):
+        return self.query("get_chat_version", list(conversation_key(user1, user2))).fetchone()
+
+    #-----------------------------------------------------------------------------
+
+    # Returns the id of the conversation between two users, in either order
+    # Known ids come from memory, otherwise it's one lookup on the Chats key
+    # With create the conversation is made if needed, otherwise None means there isn't one
+    def get_conversation_id(self, user1, user2, create=False):
+        key = conversation_key(user1, user2)
+        chat_id = self.conversations.get(key)
+        if chat_id is not None:
+            return chat_id
+
+        if create:
+            # Does nothing to an existing row but still returns its id
+            res = self.query("create_chat", list(key)).fetchone()
+            self.commit()
         else:
-            return True
-        
+            res = self.query("get_chat_id", list(key)).fetchone()
+
+        if res is None:
+            return None
+
+        with self.conversations_lock:
+            # Drop the oldest entry rather than grow without limit
+            if len(self.conversations) >= self.conversations_max:
+                self.conversations.pop(next(iter(self.conversations)))
+            self.conversations[key] = res[0]
+        return res[0]
+
+    # Forgets cached conversation ids, for every conversation of username if given
+    def forget_conversations(self, username=None):
+        with self.conversations_lock:
+            if username is None:
+                self.conversations.clear()
+                return
+            for key in [key for key in self.conversations if username in key]:
+                del self.conversations[key]
+
+    def chat_exists(self, user1, user2):
+        return self.get_conversation_id(user1, user2) is not None
         
-    def add_chat(self, user1, user2, size=0):
-        data = [user1, user2, size]
-        self.cur.execute("INSERT INTO Chats VALUES(?, ?, ?)", data)
-        self.commit()
+    def add_chat(self, user1, user2):
+        self.get_conversation_id(user1, user2, create=True)
         
         return True
     
+    # Stores a message in one transaction of two statements
+    # Returns False if the two users have no chat
     def add_message(self, sender, receiver, message):
-        data = [sender, receiver] if self.chat_exists(sender, receiver) else [receiver, sender]
-
-        message_index = self.cur.execute("SELECT size FROM Chats WHERE user1 = ? AND user2 = ?", data).fetchone()
-        message_index = message_index[0] + 1
-        self.cur.execute("UPDATE Chats SET size = ? WHERE user1 = ? AND user2 = ?", [message_index] + data)
-        data = [sender, receiver, message, message_index]
-        self.cur.execute("INSERT INTO Messages VALUES(?, ?, ?, ?)", data)
-        print("ADDED MESSAGE: ", data)
-        self.commit()
+        chat_id = self.get_conversation_id(sender, receiver)
+        if chat_id is None:
+            return False
+
+        if self.group_committer is not None:
+            message_index = self.group_committer.submit(chat_id, sender, receiver, message)
+        else:
+            message_index = insert_message(self.query, chat_id, sender, receiver, message)
+            self.commit()
+
+        if message_index is None:
+            # Deleted by another process since we cached its id
+            self.forget_conversations(sender)
+            return False
+
+        data = [chat_id, sender, receiver, message, message_index]
+        logger.debug("Added message %d to chat %d from %s to %s", message_index, chat_id, sender, receiver)
+
+        # "message" listeners get (chat_id, sender, receiver, message, message_index)
+        self.notify("message", *data)
         
         return True
     
-    def get_chat_history(self, user1, user2):
-        sql_query = """
-                SELECT sender, message
-                FROM Messages
-                WHERE (sender = '{user1}' AND receiver = '{user2}')
-                OR (sender = '{user2}' AND receiver = '{user1}')
-                ORDER BY message_index ASC
-            """
-        sql_query = sql_query.format(user1=user1, user2=user2) if self.chat_exists(user1, user2) else sql_query.format(user1=user2, user2=user1)
-        res = self.execute(sql_query)
+    # Returns one page of a conversation as (sender, message, message_index) rows, oldest first
+    # Without before this is the newest page, otherwise the page just older than that message_index
+    # With after it is instead the page just newer than that message_index
+    # All forms are a single seek on Messages_chat, however long the conversation is
+    def get_chat_page(self, user1, user2, limit=50, before=None, after=None):
+        chat_id = self.get_conversation_id(user1, user2)
+        if chat_id is None:
+            return []
 
-        if res is not None:
-            chat_history = "".join([f'<div class="message"><strong>{message[0]}:</strong> {message[1]}</div>' for message in res.fetchall()])
-            return chat_history
+        if after is not None:
+            return self.query("chat_page_after", [chat_id, after, limit]).fetchall()
+
+        if before is None:
+            res = self.query("chat_page_newest", [chat_id, limit])
         else:
-            return None
+            res = self.query("chat_page_before", [chat_id, before, limit])
+
+        page = res.fetchall()
+        page.reverse()
+        return page
         
+    # Returns (chat_id, sender, receiver, message_index, snippet) for messages in username's
+    # conversations holding every word of text, best match first
+    # Matched words in the snippet are wrapped in \x02 and \x03
+    def search_messages(self, username, text, limit=20, offset=0):
+        chat_ids = [row[0] for row in self.query("get_user_chats", [username, username])]
+        expression = match_expression(text, chat_ids)
+        if expression is None:
+            return []
+        return self.query("search_messages", [expression, limit, offset]).fetchall()
+
+    # Rebuilds the search index from Messages, for when it has been lost or damaged
+    def rebuild_message_search(self):
+        try:
+            self.query("rebuild_message_search")
+            self.query("optimize_message_search")
+            self.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+
     def get_course_guides(self):
-        sql_query = """
-                SELECT course_code, course_name, course_description
-                FROM Guides
-            """
-        res = self.execute(sql_query)
+        return self.query("get_guides").fetchall()
 
-        if res is not None:
-            course_guides = res.fetchall()
-            return course_guides
-        else:
-            return None
-        
-    def add_course_guide(self, course_code, course_name, course_description):
-        sql_query = """
-                INSERT INTO Guides VALUES(?, ?, ?)
-            """
-        res = self.cur.execute(sql_query, [course_code, course_name, course_description])
-        self.commit()
+    # The most recently added guides, newest first
+    def get_latest_guides(self, limit=10):
+        return self.query("latest_guides", [limit]).fetchall()
 
-        if res is not None:
-            return True
-        else:
+    # A page of guides, by course code, or ranked by how well they match text if given
+    # Every word of text has to match a code, name or description, the last one as a prefix
+    def search_course_guides(self, text=None, limit=20, offset=0):
+        terms = match_terms(text or "", prefix_last=True)
+        if terms is None:
+            return self.query("guides_page", [limit, offset]).fetchall()
+        return self.query("search_guides", [terms, limit, offset]).fetchall()
+
+    # Returns (course_code, course_name) for the first guides whose code starts with prefix
+    # A single range seek on the course_code index, however big the catalogue
+    def autocomplete_course_codes(self, prefix, limit=10):
+        low, high = prefix_range(prefix)
+        return self.query("guide_codes_from", [low, high, limit]).fetchall()
+
+    # Returns False if a guide with that course code already exists
+    def add_course_guide(self, course_code, course_name, course_description):
+        try:
+            self.query("add_guide", [course_code, course_name, course_description])
+            self.commit()
+        except sqlite3.IntegrityError:
+            self.conn.rollback()
             return False
+        self.notify("guides")
+
+        return True
         
+    # Returns False if there was no such guide
     def remove_course_guide(self, course_code):
-        sql_query = """
-                DELETE FROM Guides
-                WHERE course_code = '{course_code}'
-            """
-        sql_query = sql_query.format(course_code=course_code)
-        print("REMOVE GUIDE SQL QUERY: ", sql_query)
-        res = self.execute(sql_query)
+        logger.info("Removing guide %s", course_code)
+        res = self.query("remove_guide", [course_code])
         self.commit()
+        self.notify("guides")
 
-        if res is not None:
-            return True
-        else:
-            return False
+        return res.rowcount > 0
         
     def get_course_guide(self, course_code):
-        sql_query = """
-                SELECT course_code, course_name, course_description
-                FROM Guides
-                WHERE course_code = '{course_code}'
-            """
-        sql_query = sql_query.format(course_code=course_code)
-        res = self.execute(sql_query)
-
-        if res is not None:
-            course_guide = res.fetchone()
-            return course_guide
-        else:
-            return None
+        return self.query("get_guide", [course_code]).fetchone()
         
     def init_course_guides(self):
-        sql_query = """
-                INSERT INTO Guides VALUES('INFO1110', 'Intro to Programming', 'This course is an introduction to computer science. It covers the basics of programming in Python.');
-                INSERT INTO Guides VALUES('INFO1113', 'Object-Oriented Programming', 'This course is an introduction to computer science. It covers the basics of programming in Java.');
-                INSERT INTO Guides VALUES('COMP2123', 'Data Structures and Algorithms', 'This course is an introduction to data structures and algorithms. It covers the basics of data structures and algorithms.');
-                INSERT INTO Guides VALUES('COMP2017', 'Systems Programming', 'This course is an introduction to operating systems and machine principles. It covers the basics of operating systems and machine principles.');
-            """
-        res = self.execute(sql_query)
-        self.commit()
+        try:
+            self.query_many("add_guide", COURSE_GUIDES)
+            self.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        self.notify("guides")
 
-        if res is not None:
-            return True
-        else:
-            return False
+        return True
         
-    def are_friends(self, user1, user2):
-        sql_query = """
-                SELECT *
-                FROM Friends
-                WHERE user1 = '{user1}' AND user2 = '{user2}'
-            """
-        sql_query = sql_query.format(user1=user1, user2=user2)
-        res = self.execute(sql_query)
+    #-----------------------------------------------------------------------------
+    # Friends
+    # Reads go through friend_graph, writes update it once they've committed
+    #-----------------------------------------------------------------------------
 
-        if res is not None:
-            return True
-        else:
-            return False
+    # Returns the frozenset of users username has added
+    def friends_of(self, username):
+        friends = self.friend_graph.get(username)
+        if friends is not None:
+            return friends
+
+        with self.friends_lock:
+            version = self.friend_versions.get(username, 0)
+
+        res = self.query("get_friends", [username])
+        friends = frozenset(row[0] for row in res)
+
+        with self.friends_lock:
+            if self.friend_versions.get(username, 0) == version:
+                self.friend_graph.put(username, friends)
+        return friends
+
+    # Applies a committed change to username's cached friends, if they're cached
+    def update_friends(self, username, change):
+        with self.friends_lock:
+            self.friend_versions[username] = self.friend_versions.get(username, 0) + 1
+            friends = self.friend_graph.peek(username)
+            if friends is not None:
+                self.friend_graph.put(username, change(friends))
+
+    # Drops username's cached friends so the next read goes to the database
+    def refresh_friends(self, username):
+        with self.friends_lock:
+            self.friend_versions[username] = self.friend_versions.get(username, 0) + 1
+            self.friend_graph.pop(username)
+
+    # Drops a removed or muted user from the graph, their friendships are gone both ways
+    def forget_friends(self, username):
+        with self.friends_lock:
+            self.friend_versions[username] = self.friend_versions.get(username, 0) + 1
+            self.friend_graph.pop(username)
+            for user, friends in self.friend_graph.items():
+                if username in friends:
+                    self.friend_versions[user] = self.friend_versions.get(user, 0) + 1
+                    self.friend_graph.put(user, friends - {username})
+
+    def are_friends(self, user1, user2):
+        return user2 in self.friends_of(user1)
         
     def add_friend(self, user1, user2):
-        sql_query = """
-                INSERT INTO Friends VALUES('{user1}', '{user2}')
-            """
-        sql_query = sql_query.format(user1=user1, user2=user2)
-        res = self.execute(sql_query)
-        self.commit()
-
-        if res is not None:
-            return True
-        else:
+        try:
+            self.query("add_friend", [user1, user2])
+            self.commit()
+        except sqlite3.IntegrityError:
+            # Already friends
+            self.conn.rollback()
             return False
+
+        self.update_friends(user1, lambda friends: friends | {user2})
+        self.notify("friends", user1)
+        return True
         
+    # Returns [(friend,), ...] sorted by name, the same rows the Friends index gives
     def get_friends(self, username):
-        sql_query = """
-                SELECT user2
-                FROM Friends
-                WHERE user1 = '{username}'
-            """
-        sql_query = sql_query.format(username=username)
-        res = self.execute(sql_query)
-
-        if res is not None:
-            return res.fetchall()
-        else:
-            return None
+        return [(friend,) for friend in sorted(self.friends_of(username))]
         
     def remove_friend(self, user1, user2):
-        sql_query = """
-                DELETE FROM Friends
-                WHERE user1 = '{user1}' AND user2 = '{user2}'
-            """
-        sql_query = sql_query.format(user1=user1, user2=user2)
-        res = self.execute(sql_query)
+        self.query("remove_friend", [user1, user2])
         self.commit()
 
-        if res is not None:
-            return True
-        else:
-            return False
+        self.update_friends(user1, lambda friends: friends - {user2})
+        self.notify("friends", user1)
+        return True
         
+    # Returns False if the user already has that todo
     def add_todo(self, username, todo):
         try:
-            sql_query = """
-                    INSERT INTO Todos VALUES(?, ?)
-                """
-            
-            #sql_query = sql_query.format(username=username, todo)
-            self.cur.execute(sql_query, [username, todo])
+            self.query("add_todo", [username, todo])
             self.commit()
+        except sqlite3.IntegrityError:
+            self.conn.rollback()
+            return False
+        self.notify("todos", username)
 
-            # if res is not None:
-            #     return True
-            # else:
-            #     return False
-        except sqlite3.Error as error:
-            print("Failed to insert data into sqlite table", error)
+        return True
     
     def get_todos(self, username):
-        try:
-            sql_query = """
-                    SELECT todo
-                    FROM Todos
-                    WHERE username = '{username}'
-                """
-            sql_query = sql_query.format(username=username)
-
-            # print(sql_query)
-            res = self.execute(sql_query)
-            
-            if res is not None:
-                todos = res.fetchall()
-                print(todos)
-                return todos
-            else:
-                print("FAILED TO GET TODOS", res)
-                return None
-        except sqlite3.Error as error:
-            print("Failed to get Todos", error)
+        return self.query("get_todos", [username]).fetchall()
         
     def remove_todo(self, username, todo):
-        print("TRING TO REMOVE TODO", username, todo)
-        sql_query = """
-                DELETE FROM Todos
-                WHERE username = ? AND todo = ?
-            """
-        #sql_query = sql_query.format(username=username, todo=todo.replace(" ", "#"))
-        res = self.cur.execute(sql_query, [username, todo])
+        logger.debug("Removing todo %r for %s", todo, username)
+        res = self.query("remove_todo", [username, todo])
         self.commit()
+        self.notify("todos", username)
 
-        if res is not None:
-            return True
-        else:
-            return False
\ No newline at end of file
+        return res.rowcount > 0
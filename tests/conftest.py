@@ -0,0 +1,111 @@
+'''
+    Shared setup for the tests
+
+    model.py opens its database and scans the templates when it is imported,
+    so the tests point it at a copy of project.db and import it once, from
+    the repository root, for the whole session
+'''
+import io
+import os
+import shutil
+import sys
+import tempfile
+import urllib.parse
+import uuid
+
+import bcrypt
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORKDIR = tempfile.mkdtemp(prefix='student-talk-test-')
+shutil.copy(os.path.join(ROOT, 'project.db'), os.path.join(WORKDIR, 'project.db'))
+os.environ['STUDENT_TALK_DB'] = os.path.join(WORKDIR, 'project.db')
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+import bottle
+import model
+import controller
+
+model.db.migrate()
+model.end_request()
+
+# Cheap hashes, the tests are about what happens around bcrypt rather than bcrypt itself
+PASSWORD = 'password'
+PASSWORD_HASH = bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt(4))
+
+
+class Client():
+    '''
+        Calls the bottle app directly through WSGI
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def call(self, method, path, data=None, headers=None):
+        '''
+            Returns (status code, headers dict, body bytes)
+        '''
+        path, _, query = path.partition('?')
+        body = urllib.parse.urlencode(data or {}).encode('utf-8')
+        environ = {
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'wsgi.url_scheme': 'http',
+            'CONTENT_LENGTH': str(len(body)),
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+        }
+        for name, value in (headers or {}).items():
+            environ['HTTP_' + name.upper().replace('-', '_')] = value
+
+        started = {}
+        def start_response(status, response_headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = dict(response_headers)
+
+        chunks = self.app(environ, start_response)
+        try:
+            data = b''.join(chunks)
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+        return started['status'], started['headers'], data
+
+    def get(self, path, **kwargs):
+        return self.call('GET', path, **kwargs)
+
+    def post(self, path, data=None, **kwargs):
+        return self.call('POST', path, data=data, **kwargs)
+
+
+@pytest.fixture
+def client():
+    return Client(bottle.default_app())
+
+
+@pytest.fixture
+def make_user():
+    '''
+        Returns a function that adds a user with a fresh name and PASSWORD, and returns the name
+    '''
+    def make(prefix='user'):
+        username = '{prefix}_{suffix}'.format(prefix=prefix, suffix=uuid.uuid4().hex[:8])
+        model.db.add_user(username, PASSWORD_HASH)
+        model.end_request()
+        return username
+    return make
+
+
+def cookie(username):
+    '''
+        Returns the headers of a request signed in as username
+    '''
+    token = model.session_store.create(username)
+    model.end_request()
+    return {'Cookie': '{name}={token}'.format(name=model.SESSION_COOKIE, token=token)}
@@ -0,0 +1,34 @@
+'''
+    Bulk uploads racing each other report every row instead of failing
+'''
+import threading
+import uuid
+
+import model
+
+
+def test_concurrent_guide_uploads_report_exists():
+    codes = ['T{suffix}{i}'.format(suffix=uuid.uuid4().hex[:6], i=i) for i in range(50)]
+    rows = [(code, 'Course', 'Description') for code in codes]
+
+    results = []
+    errors = []
+    def upload():
+        try:
+            results.append(model.db.add_course_guides(rows))
+        except Exception as error:
+            errors.append(error)
+        finally:
+            model.end_request()
+
+    threads = [threading.Thread(target=upload) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    for code in codes:
+        outcomes = [dict(result)[code] for result in results]
+        assert outcomes.count('added') == 1
+        assert outcomes.count('exists') == len(threads) - 1
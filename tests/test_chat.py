@@ -0,0 +1,27 @@
+'''
+    Chat messages reach the page as text, never as markup
+'''
+import model
+from conftest import cookie
+
+
+def test_messages_are_escaped(client, make_user):
+    sender = make_user('sender')
+    receiver = make_user('receiver')
+    model.db.add_friend(sender, receiver)
+    model.end_request()
+
+    status, _, _ = client.post('/chat/send', {'receiver': receiver, 'message': '<b>x</b>'}, headers=cookie(sender))
+    assert status == 204
+
+    headers = cookie(receiver)
+    outputs = [
+        client.get('/chat?friend=' + sender, headers=headers)[2],
+        client.get('/chat/history?friend={friend}&before=1000000'.format(friend=sender), headers=headers)[2],
+        client.get('/chat/stream?friend={friend}&after=0'.format(friend=sender), headers=headers)[2],
+    ]
+    model.end_request()
+
+    for body in outputs:
+        assert b'&lt;b&gt;x&lt;/b&gt;' in body
+        assert b'<b>x</b>' not in body
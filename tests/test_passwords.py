@@ -0,0 +1,64 @@
+'''
+    Logins waiting on bcrypt mustn't keep the other routes from the database
+'''
+import threading
+import time
+
+import bcrypt
+import passwords
+
+import model
+from conftest import PASSWORD, cookie
+
+
+def test_logins_waiting_on_bcrypt_leave_connections_free(client, make_user, monkeypatch):
+    username = make_user('login')
+    reader = make_user('reader')
+    headers = cookie(reader)
+
+    # Hold every login inside the password pool until the end of the test
+    gate = threading.Event()
+    checkpw = bcrypt.checkpw
+    def held_checkpw(password, hashed):
+        gate.wait(10)
+        return checkpw(password, hashed)
+    monkeypatch.setattr(passwords.bcrypt, 'checkpw', held_checkpw)
+
+    # More logins than there are database connections, fewer than the pool turns away
+    logins = model.db.pool.size + 4
+    assert logins <= model.password_pool.workers + model.password_pool.max_queue
+    monkeypatch.setattr(model.db.pool, 'timeout', 1.0)
+
+    statuses = []
+    def login():
+        statuses.append(client.post('/login', {'username': username, 'password': PASSWORD})[0])
+        model.end_request()
+
+    threads = [threading.Thread(target=login) for _ in range(logins)]
+    for thread in threads:
+        thread.start()
+    try:
+        deadline = time.monotonic() + 5
+        while model.password_pool.in_flight < logins and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert model.password_pool.in_flight == logins
+
+        status, _, _ = client.get('/friend_list', headers=headers)
+        model.end_request()
+        assert status == 200
+    finally:
+        gate.set()
+        for thread in threads:
+            thread.join()
+
+    assert statuses == [200] * logins
+
+
+def test_password_timings_are_exported(client, make_user):
+    username = make_user('metrics')
+    assert client.post('/login', {'username': username, 'password': PASSWORD})[0] == 200
+    model.end_request()
+
+    body = client.get('/metrics')[2].decode('utf-8')
+    for name in ('password_hash_seconds_total', 'password_max_wait_seconds', 'password_wait_seconds_total'):
+        assert 'student_talk_{name}{{kind="check"}}'.format(name=name) in body
@@ -0,0 +1,50 @@
+'''
+    The default server keeps serving pages while chat tabs are open
+'''
+import http.client
+import os
+import shutil
+import sys
+import time
+
+import pytest
+
+from conftest import ROOT
+
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import serving
+
+
+def read_status(sock):
+    sock.settimeout(5)
+    return int(sock.recv(64).split(b' ', 2)[1])
+
+
+def test_pages_load_while_streams_are_open(tmp_path):
+    pytest.importorskip('gunicorn')
+    database = str(tmp_path / 'project.db')
+    shutil.copy(os.path.join(ROOT, 'project.db'), database)
+    cookie = serving.session_cookie(database)
+
+    process, port = serving.start_server('gunicorn', database)
+    streams = []
+    try:
+        # More idle chat tabs than the worker has threads
+        streams = serving.open_streams(port, 40, cookie)
+        time.sleep(0.5)
+
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        conn.request('GET', '/about')
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        assert response.status == 200
+
+        # The streams past the limit were turned away rather than left waiting for a thread
+        statuses = [read_status(sock) for sock in streams]
+        assert statuses.count(200) == serving.LONG_POLL_LIMIT
+        assert statuses.count(503) == len(streams) - serving.LONG_POLL_LIMIT
+    finally:
+        for sock in streams:
+            sock.close()
+        serving.stop_server(process)
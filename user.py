@@ -1,3 +1,8 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
 class User:
     def __init__(self, username):
         self.username = username
@@ -7,13 +12,13 @@ class User:
         if friend_username not in self.friends:
             self.friends.append(friend_username)
         else:
-            print(f"{friend_username} is already a friend.")
+            logger.debug("%s is already a friend", friend_username)
 
     def remove_friend(self, friend_username):
         if friend_username in self.friends:
             self.friends.remove(friend_username)
         else:
-            print(f"{friend_username} is not a friend.")
+            logger.debug("%s is not a friend", friend_username)
 
     def __repr__(self):
         return f"<User username={self.username}, friends={self.friends}>"
@@ -3,7 +3,16 @@
 # You can find a fuller explanation for this file in the README file
 #-----------------------------------------------------------------------------
 
+import hashlib
+import os
+import re
 import string
+import logging
+
+logger = logging.getLogger(__name__)
+
+# HTML comments, conditional comments are kept as browsers act on them
+COMMENT = re.compile(r"<!--(?!\[if).*?-->", re.DOTALL)
 
 class View():
     '''
@@ -14,15 +23,35 @@ class View():
 
         To display different headers when logged in, be sure to replace the
         header keyword argument when calling the function from model
+
+        Templates are read once and kept in memory, each header/body/tailer
+        combination is joined and parsed once too. While reload_templates is
+        on, a file is read again whenever its modification time changes
+
+        HTML comments are stripped when a combination is parsed, the
+        templates keep a lot of commented out markup and CSS
     '''
     def __init__(self, 
         template_path="templates/",  # Path to template files
         template_extension=".html",  # Extension of templates, self can be overridden
+        reload_templates=True,  # Check files for changes, turn this off in production
+        strip_comments=True,  # Leave HTML comments out of rendered pages
         **kwargs): # Used to pass any global format arguments
         self.template_path = template_path
         self.template_extension = template_extension
+        self.reload_templates = reload_templates
+        self.strip_comments = strip_comments
         self.global_renders = kwargs
 
+        # filename -> (modification time, text)
+        self.templates = {}
+
+        # (body, header, tailer) -> (source texts, string.Template of them joined)
+        self.compiled = {}
+
+        # See version()
+        self.stamp = None
+
 
     def __call__(self, *args, **kwargs):
         '''
@@ -40,34 +69,76 @@ class View():
             :: tailer :: Tailer template to use
             :: kwargs :: Keyword arguments to pass
         '''
-        body_template = self.load_template(filename)
-        header_template = self.load_template(header)
-        tailer_template = self.load_template(tailer)
+        template = self.compile(filename, header, tailer)
 
-        rendered_template = self.render(
-            body_template=body_template, 
-            header_template=header_template, 
-            tailer_template=tailer_template, 
-            **kwargs)
+        # Local arguments win over global ones, as they did when globals were a second pass
+        renders = dict(self.global_renders)
+        renders.update(kwargs)
+        return template.safe_substitute(**renders)
 
-        return rendered_template
+
+    def compile(self, filename, header="header", tailer="tailer"):
+        '''
+            compile
+            Returns the parsed header + body + tailer template, rebuilding it
+            only if one of the three files has changed
+        '''
+        sources = (self.load_template(header), self.load_template(filename), self.load_template(tailer))
+        key = (filename, header, tailer)
+
+        cached = self.compiled.get(key)
+        if cached is not None and all(old is new for old, new in zip(cached[0], sources)):
+            return cached[1]
+
+        text = "".join(sources)
+        if self.strip_comments:
+            text = COMMENT.sub("", text)
+        template = string.Template(text)
+        self.compiled[key] = (sources, template)
+        return template
+
+
+    def version(self):
+        '''
+            version
+            Returns a stamp that changes whenever a template file or a global
+            render does, for ETags of rendered pages
+        '''
+        if self.stamp is not None and not self.reload_templates:
+            return self.stamp
+
+        digest = hashlib.blake2b(digest_size=8)
+        for filename in sorted(os.listdir(self.template_path)):
+            info = os.stat(os.path.join(self.template_path, filename))
+            digest.update("{name}:{mtime}:{size};".format(name=filename, mtime=info.st_mtime_ns, size=info.st_size).encode())
+        for name, value in sorted(self.global_renders.items()):
+            digest.update("{name}={value};".format(name=name, value=value).encode())
+        self.stamp = digest.hexdigest()
+        return self.stamp
 
 
     def load_template(self, filename):
         '''
-            simple_render 
-            A simple render using the format method
+            load_template
+            Returns the text of a template file, from memory unless it has changed
             
-            :: template :: The template to use
-            :: kwargs :: A dictionary of key value pairs to pass to the template
+            :: filename :: The name of the template, without path or extension
         '''
         path = self.template_path + filename + self.template_extension
-        file = open(path, 'r')
-        print("Loading template: {path}".format(path=path))
-        text = ""
-        for line in file:
-            text+= line
-        file.close()
+        cached = self.templates.get(filename)
+
+        if cached is not None and not self.reload_templates:
+            return cached[1]
+
+        mtime = os.stat(path).st_mtime_ns
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        logger.debug("Loading template %s", path)
+        with open(path, 'r') as file:
+            text = file.read()
+
+        self.templates[filename] = (mtime, text)
         return text
 
 